@@ -71,6 +71,11 @@ Credits: External AI for finding ALL 4 critical bugs (100% precision)
 """
 
 import os, re, logging
+import bisect
+import csv
+import hashlib
+import pickle
+import shutil
 import sys
 import argparse
 import subprocess
@@ -78,13 +83,12 @@ import time as _time
 import psutil
 from pathlib import Path
 from typing import Optional, Dict, Tuple, List, Set
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import numpy as np
 import pandas as pd
 import warnings
-from scipy.stats import percentileofscore
 
 warnings.filterwarnings('ignore', category=pd.errors.PerformanceWarning)
 
@@ -100,7 +104,6 @@ logger = logging.getLogger(__name__)
 
 # ===== MODO INCREMENTAL =====
 INCREMENTAL_MODE = False
-RECALC_TAIL_DAYS = 9999
 
 # ===== SCHEDULER (V19 - AUTO-LOOP) =====
 RUN_HOUR   = 10
@@ -132,6 +135,8 @@ CLOSE_MS_TOLERANCE_MS = 60000
 # Ventanas rolling
 WINDOWS = [7, 21, 63, 252]
 W_ALIAS = 63
+HV_WINDOWS = [7, 21, 63, 252]     # calculate_hv_vrp
+IV_Z_WINDOWS = (20, 63, 252)       # calculate_iv_zscores
 
 # Pesos para score combinado
 SCORE_WEIGHTS = (0.60, 0.35, 0.05)  # (IV, SKEW, VRP)
@@ -212,6 +217,7 @@ MIN_CONTRACTS_FOR_EXPANSION = 8
 # Interpolación
 ENABLE_INTERPOLATION = True
 INTERPOLATION_METHOD = 'weighted'
+ATM_INTERPOLATION = False  # IV/strike ATM interpolados entre los contratos que rodean 50Δ
 
 # Validación
 ENABLE_ARBITRAGE_CHECK = True
@@ -220,18 +226,58 @@ ENABLE_MONOTONICITY_CHECK = True
 # Otros parámetros
 VRP_HORIZON_DAYS = 7
 LN_RATIO_EPS = 1e-4
-WRITE_PARQUET = True
+WRITE_PARQUET = True  # Superficie maestra como dataset Parquet particionado (year=/month=)
+WRITE_MASTER_CSV = True  # surface_metrics.csv en orden de fecha (en incremental solo se reescribe desde since)
+CSV_WRITE_WORKERS = 8  # Hilos para escribir los CSVs por bucket
 MAX_WORKERS = None
+PERCENTILE_WORKERS = None  # Pool de la etapa de percentiles (None → MAX_WORKERS / CPUs, 1 → secuencial)
+PERCENTILE_BUCKETS_PER_TASK = 24  # Buckets por tarea enviada al pool de percentiles
 USE_IV_BS = True
 
 REQUIRED_COLUMNS = ["date", "ms_of_day", "right", "expiration", "strike", "bid", "ask", "mid"]
 
+# Columnas opcionales que consume el pipeline (el resto del CSV no se lee)
+OPTIONAL_COLUMNS = ["IV_BS", "implied_vol", "IV", "delta", "delta_BS", SPX_PRICE_COL, "r", "volume"]
+
+# Tipos explícitos de lectura
+CSV_FLOAT_COLUMNS = [
+    "strike", "bid", "ask", "mid",
+    "IV_BS", "implied_vol", "IV", "delta", "delta_BS", SPX_PRICE_COL, "r", "volume",
+]
+CSV_CATEGORY_COLUMNS = ["date", "expiration", "right"]  # Pocos valores únicos por fichero
+
+# Lectura por bloques: solo se materializan las filas de los snapshots 12:00 / 15:30
+CSV_BLOCK_SIZE = 8 << 20   # bytes por bloque (pyarrow)
+CSV_CHUNK_ROWS = 200_000   # filas por chunk (fallback pandas)
+
+# Caché columnar (Parquet) de los snapshots ya filtrados y tipados de cada CSV
+ENABLE_RAW_CACHE = True
+RAW_CACHE_DIR = Path(OUTPUT_DIR) / ".raw_cache"
+RAW_CACHE_VERSION = 1  # Incrementar si cambia el formato de read_snapshot_rows
+
+# Memoización de resultados por fichero (rows_local / leader_local)
+ENABLE_RESULT_CACHE = True
+RESULT_CACHE_DIR = Path(OUTPUT_DIR) / ".result_cache"
+RESULT_CACHE_VERSION = 7  # Incrementar si cambia la lógica de extracción por buckets
+
 # ============================= PROGRESO =============================
 try:
     from tqdm import tqdm as _tqdm
 except ImportError:
     _tqdm = None
 
+# ============================= PYARROW (OPCIONAL) =============================
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.compute as pa_compute
+    import pyarrow.dataset as pa_ds
+except ImportError:
+    pa = None
+    pa_csv = None
+    pa_compute = None
+    pa_ds = None
+
 # ============================= CALENDARIO BURSÁTIL USA =============================
 
 USA_HOLIDAYS = [
@@ -254,26 +300,88 @@ USA_HOLIDAYS = [
 USA_HOLIDAYS_SET = set(pd.to_datetime(USA_HOLIDAYS).date)
 
 
-def is_trading_day(date_obj: pd.Timestamp) -> bool:
-    """Verifica si una fecha es día trading"""
-    dt = pd.to_datetime(date_obj).date()
-    if dt.weekday() >= 5:
-        return False
-    if dt in USA_HOLIDAYS_SET:
-        return False
-    return True
+USA_HOLIDAYS_NS = np.array(sorted(USA_HOLIDAYS_SET), dtype="datetime64[ns]")
 
 
-def get_trading_days(start: pd.Timestamp, end: pd.Timestamp) -> pd.DatetimeIndex:
-    """Genera índice completo de días trading entre start y end"""
-    all_days = pd.date_range(start, end, freq='D')
-    trading_days = [d for d in all_days if is_trading_day(d)]
-    return pd.DatetimeIndex(trading_days)
-
-
-def count_trading_days_between(start: pd.Timestamp, end: pd.Timestamp) -> int:
-    """Cuenta días trading entre dos fechas"""
-    return len(get_trading_days(start, end))
+class TradingCalendar:
+    """
+    ⚡ Calendario bursátil USA vectorizado (fines de semana + USA_HOLIDAYS)
+    
+    Se construye una vez por ejecución y lo comparten percentiles, cobertura y
+    forward-fill. Posiciones por searchsorted, conteos por aritmética de índices
+    y rangos memoizados.
+    """
+    
+    def __init__(self, start: pd.Timestamp, end: pd.Timestamp):
+        self._build(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize())
+    
+    def _build(self, start: pd.Timestamp, end: pd.Timestamp):
+        all_days = pd.date_range(start, end, freq='D')
+        self.start = start
+        self.end = end
+        self.days = all_days[self.trading_mask(all_days)]
+        self.values = self.days.values
+        self._ranges: Dict[Tuple[pd.Timestamp, pd.Timestamp], pd.DatetimeIndex] = {}
+    
+    @staticmethod
+    def trading_mask(dates) -> np.ndarray:
+        """Máscara vectorizada: día laborable y no festivo"""
+        d = pd.DatetimeIndex(dates).normalize()
+        return (d.dayofweek < 5) & ~np.isin(d.values, USA_HOLIDAYS_NS)
+    
+    def __len__(self) -> int:
+        return len(self.days)
+    
+    def _ensure(self, start: pd.Timestamp, end: pd.Timestamp):
+        """Amplía el calendario si [start, end] sale de su rango (cambia posiciones)"""
+        if start < self.start or end > self.end:
+            self._build(min(start, self.start), max(end, self.end))
+    
+    def positions(self, dates) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Posición de cada fecha en el calendario (searchsorted) y si pertenece a él
+        
+        La posición es el número de días del calendario estrictamente anteriores.
+        """
+        d = pd.to_datetime(dates).to_numpy(dtype="datetime64[ns]")
+        pos = np.searchsorted(self.values, d, side="left")
+        if len(self.values) == 0:
+            return pos, np.zeros(len(d), dtype=bool)
+        in_cal = (pos < len(self.values)) & (self.values[np.minimum(pos, len(self.values) - 1)] == d)
+        return pos, in_cal
+    
+    def range(self, start: pd.Timestamp, end: pd.Timestamp) -> pd.DatetimeIndex:
+        """Días trading en [start, end] (memoizado)"""
+        key = (pd.Timestamp(start), pd.Timestamp(end))
+        cached = self._ranges.get(key)
+        if cached is None:
+            self._ensure(key[0].normalize(), key[1].normalize())
+            lo = self.days.searchsorted(key[0], side="left")
+            hi = self.days.searchsorted(key[1], side="right")
+            cached = self.days[lo:hi]
+            self._ranges[key] = cached
+        return cached
+    
+    def count_between(self, start: pd.Timestamp, end: pd.Timestamp) -> int:
+        """Días trading en [start, end] por aritmética de índices"""
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        self._ensure(start.normalize(), end.normalize())
+        return max(0, int(self.days.searchsorted(end, side="right") - self.days.searchsorted(start, side="left")))
+
+
+# Calendario compartido del proceso (ffill sin calendario explícito)
+_TRADING_CALENDAR: Optional[TradingCalendar] = None
+
+
+def get_trading_calendar(start: pd.Timestamp, end: pd.Timestamp) -> TradingCalendar:
+    """Calendario compartido del proceso, ampliado bajo demanda"""
+    global _TRADING_CALENDAR
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    if _TRADING_CALENDAR is None:
+        _TRADING_CALENDAR = TradingCalendar(start, end)
+    else:
+        _TRADING_CALENDAR._ensure(start, end)
+    return _TRADING_CALENDAR
 
 
 # ============================= UTILS =============================
@@ -281,26 +389,51 @@ def count_trading_days_between(start: pd.Timestamp, end: pd.Timestamp) -> int:
 _TIME_RE = re.compile(r'^\s*(\d{1,2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?\s*$')
 
 
-def _time_str_to_ms(x) -> float:
-    """Convierte string de tiempo a milisegundos"""
-    if not isinstance(x, str) or ":" not in x:
-        return np.nan
-    m = _TIME_RE.match(x)
-    if not m:
-        return np.nan
-    h = int(m.group(1))
-    mi = int(m.group(2))
-    se = int(m.group(3))
-    frac = m.group(4)
-    ms = int((frac + "000")[:3]) if frac else 0
-    return ((h * 60 + mi) * 60 + se) * 1000 + ms
+def _time_strs_to_ms(s: pd.Series) -> np.ndarray:
+    """
+    ⚡ Convierte strings de tiempo HH:MM:SS(.ffffff) a milisegundos en bloque
+    
+    Usa pyarrow.compute (regex RE2 en bloque) si está disponible; si no,
+    str.extract de pandas. Los valores que no casan devuelven NaN.
+    """
+    out = np.full(len(s), np.nan)
+    
+    if pa_compute is not None:
+        try:
+            arr = pa.array(s.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Tipos mezclados: los no-texto nunca casan con el patrón
+            arr = pa.array(s.astype(str).to_numpy(dtype=object), type=pa.string())
+        parts = pa_compute.extract_regex(
+            arr,
+            r"^\s*(?P<h>\d{1,2}):(?P<m>\d{2}):(?P<s>\d{2})(?:\.(?P<f>\d{1,6}))?\s*$"
+        )
+        valid = parts.is_valid()
+        parts = parts.filter(valid)
+        h, mi, se = (
+            parts.field(k).cast(pa.int64()).to_numpy() for k in ("h", "m", "s")
+        )
+        frac = pa_compute.utf8_slice_codeunits(
+            pa_compute.utf8_rpad(parts.field("f"), width=3, padding="0"), 0, 3
+        ).cast(pa.int64()).to_numpy()
+        out[valid.to_numpy(zero_copy_only=False)] = ((h * 60 + mi) * 60 + se) * 1000 + frac
+        return out
+    
+    parts = s.astype(str).str.extract(_TIME_RE.pattern)
+    h, mi, se = (pd.to_numeric(parts[i]).to_numpy() for i in range(3))
+    frac = pd.to_numeric(
+        parts[3].fillna("").str.pad(3, side="right", fillchar="0").str.slice(0, 3)
+    ).to_numpy()
+    ms = ((h * 60 + mi) * 60 + se) * 1000 + frac
+    out[:] = ms
+    return out
 
 
 def normalize_ms_of_day(s: pd.Series) -> pd.Series:
     """Normaliza ms_of_day a formato estándar"""
     s_raw = s.copy()
     if s_raw.dtype == object or (len(s_raw) > 0 and isinstance(s_raw.iloc[0], str)):
-        s_time = s_raw.apply(_time_str_to_ms)
+        s_time = pd.Series(_time_strs_to_ms(s_raw), index=s_raw.index)
         if s_time.notna().sum() >= max(3, int(0.5 * len(s_time))):
             arr = s_time.astype(float)
         else:
@@ -358,20 +491,6 @@ def safe_median(x):
         return float(s.median(skipna=True)) if s.notna().any() else np.nan
 
 
-def safe_quantile(x, q: float):
-    """Cuantil robusto"""
-    s = pd.to_numeric(pd.Series(x), errors="coerce").dropna()
-    with np.errstate(invalid='ignore'):
-        return float(np.percentile(s, q * 100)) if len(s) > 0 else np.nan
-
-
-def safe_mean(x):
-    """Media robusta"""
-    s = pd.to_numeric(pd.Series(x), errors="coerce")
-    with np.errstate(invalid='ignore'):
-        return float(s.mean(skipna=True)) if s.notna().any() else np.nan
-
-
 def level10_from_score(x: float) -> float:
     """Convierte score [0,1] a nivel [1,10]"""
     if pd.isna(x):
@@ -416,287 +535,574 @@ def safe_sorted_unique(series: pd.Series) -> list:
 
 # ============================= INTERPOLACIÓN =============================
 
-def interpolate_to_fixed_point(
-    sub_df: pd.DataFrame,
-    target_delta: float,
-    target_dte: int,
+def interpolate_to_fixed_points_batch(
+    members: pd.DataFrame,
     method: str = 'weighted'
-) -> Dict[str, float]:
+) -> pd.DataFrame:
     """
-    V18: Interpola IV y métricas al punto exacto (delta_rep, dte_rep)
+    ⚡ V18: Interpola IV al punto exacto (delta_rep, dte_rep) de todos los buckets del día a la vez
+
+    Recibe la tabla de build_bucket_members (gid consecutivo, delta_id, dte_id)
+    y devuelve un DataFrame indexado por gid con IV_interpolated, delta_actual,
+    dte_actual, n_contracts_used e interpolation_quality.
     """
-    if sub_df.empty:
-        return {
-            'IV_interpolated': np.nan,
-            'delta_actual': np.nan,
-            'dte_actual': np.nan,
-            'n_contracts_used': 0,
-            'interpolation_quality': 'NO_DATA'
-        }
-    
-    sub_df = sub_df.copy()
-    sub_df['delta_dist'] = (sub_df['delta_abs'] * 100 - target_delta).abs()
-    sub_df['dte_dist'] = (sub_df['dte_days'] - target_dte).abs()
-    
-    sub_df['total_dist'] = np.sqrt(
-        (sub_df['delta_dist'] / 10.0) ** 2 +
-        (sub_df['dte_dist'] / 10.0) ** 2
+    gid = members["gid"].to_numpy()
+    n = gid.size
+    n_groups = int(gid.max()) + 1
+
+    rep_d = np.array([db["rep"] for db in DELTA_BUCKETS], dtype=float)[members["delta_id"].to_numpy()]
+    rep_t = np.array([tb["rep"] for tb in DTE_BUCKETS], dtype=float)[members["dte_id"].to_numpy()]
+    delta_pct = members["delta_abs"].to_numpy(dtype=float) * 100
+    dte_days = members["dte_days"].to_numpy(dtype=float)
+    iv = members["IV"].to_numpy(dtype=float)
+
+    total_dist = np.sqrt(
+        (np.abs(delta_pct - rep_d) / 10.0) ** 2 +
+        (np.abs(dte_days - rep_t) / 10.0) ** 2
     )
-    
-    sub_df = sub_df.sort_values('total_dist')
-    
-    if len(sub_df) == 1:
-        row = sub_df.iloc[0]
-        return {
-            'IV_interpolated': float(row['IV']),
-            'delta_actual': float(row['delta_abs'] * 100),
-            'dte_actual': int(row['dte_days']),
-            'n_contracts_used': 1,
-            'interpolation_quality': 'SINGLE_POINT'
-        }
-    
-    n_use = min(3, len(sub_df))
-    closest = sub_df.head(n_use)
-    
+
+    # Orden (gid, distancia) y rango dentro del grupo → los 3 más cercanos
+    order = np.lexsort((np.arange(n), total_dist, gid))
+    g_sorted = gid[order]
+    starts = np.searchsorted(g_sorted, np.arange(n_groups), side="left")
+
+    # Empates de distancia: mismo orden que sort_values('total_dist') (quicksort,
+    # no estable) sobre las filas del grupo en su orden original
+    tied = (g_sorted[1:] == g_sorted[:-1]) & (total_dist[order][1:] == total_dist[order][:-1])
+    for g in np.unique(g_sorted[1:][tied]):
+        lo, hi = starts[g], starts[g + 1] if g + 1 < n_groups else n
+        rows = np.sort(order[lo:hi])
+        order[lo:hi] = rows[total_dist[rows].argsort(kind='quicksort')]
+    rank = np.arange(n) - starts[g_sorted]
+    sizes = np.bincount(gid, minlength=n_groups)
+    n_use = np.minimum(3, sizes)
+
+    def _gsum(g, values):
+        # Suma por grupo ignorando NaN (como Series.sum)
+        return np.bincount(g, weights=np.nan_to_num(values, nan=0.0), minlength=n_groups)
+
     if method == 'weighted':
-        weights = 1 / (closest['total_dist'] + 0.01)
-        weights = weights / weights.sum()
-        
-        iv_interpolated = (closest['IV'] * weights).sum()
-        delta_weighted = (closest['delta_abs'] * 100 * weights).sum()
-        dte_weighted = (closest['dte_days'] * weights).sum()
-        
-    else:
-        iv_interpolated = closest['IV'].head(2).mean()
-        delta_weighted = (closest['delta_abs'].head(2) * 100).mean()
-        dte_weighted = closest['dte_days'].head(2).mean()
-    
-    max_dist = closest['total_dist'].iloc[0]
-    if max_dist < 1.0:
-        quality = 'EXCELLENT'
-    elif max_dist < 3.0:
-        quality = 'GOOD'
-    elif max_dist < 5.0:
-        quality = 'FAIR'
+        top = rank < n_use[g_sorted]
+        idx, g_top = order[top], g_sorted[top]
+        weights = 1 / (total_dist[idx] + 0.01)
+        weights = weights / _gsum(g_top, weights)[g_top]
+        iv_interp = _gsum(g_top, iv[idx] * weights)
+        delta_w = _gsum(g_top, delta_pct[idx] * weights)
+        dte_w = _gsum(g_top, dte_days[idx] * weights)
     else:
-        quality = 'POOR'
-    
-    return {
-        'IV_interpolated': float(iv_interpolated),
-        'delta_actual': float(delta_weighted),
-        'dte_actual': float(dte_weighted),
+        top = rank < np.minimum(2, n_use)[g_sorted]
+        idx, g_top = order[top], g_sorted[top]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            iv_interp = _gsum(g_top, iv[idx]) / _gsum(g_top, ~np.isnan(iv[idx]))
+            delta_w = _gsum(g_top, delta_pct[idx]) / _gsum(g_top, ~np.isnan(delta_pct[idx]))
+            dte_w = _gsum(g_top, dte_days[idx]) / _gsum(g_top, ~np.isnan(dte_days[idx]))
+
+    first = order[starts]
+    min_dist = total_dist[first]
+    quality = np.select(
+        [min_dist < 1.0, min_dist < 3.0, min_dist < 5.0],
+        ['EXCELLENT', 'GOOD', 'FAIR'],
+        default='POOR'
+    ).astype(object)
+
+    single = sizes == 1
+    iv_interp = np.where(single, iv[first], iv_interp)
+    delta_w = np.where(single, delta_pct[first], delta_w)
+    dte_w = np.where(single, dte_days[first], dte_w)
+    quality[single] = 'SINGLE_POINT'
+
+    return pd.DataFrame({
+        'IV_interpolated': iv_interp,
+        'delta_actual': delta_w,
+        'dte_actual': dte_w,
         'n_contracts_used': n_use,
-        'interpolation_quality': quality
-    }
+        'interpolation_quality': quality,
+    }, index=pd.RangeIndex(n_groups, name="gid"))
+
+
+def locate_atm_by_expiration(s12: pd.DataFrame, day: pd.Timestamp) -> pd.DataFrame:
+    """
+    ⚡ IV_ATM / K_ATM de cada expiración con un argmin agrupado de |delta_abs - 0.5|
+
+    Devuelve un DataFrame indexado por expiración (ordenado) con IV_ATM, K_ATM
+    y dte. Con ATM_INTERPOLATION interpola linealmente en delta entre los
+    contratos que rodean 50Δ (si solo hay un lado, usa el más cercano).
+    """
+    blk = s12.loc[s12["expiration"].notna()]
+    if blk.empty:
+        return pd.DataFrame(columns=["IV_ATM", "K_ATM", "dte"], dtype=float)
+    exp_code, exps = pd.factorize(blk["expiration"], sort=True)
+    n, n_exp = exp_code.size, len(exps)
+
+    d = blk["delta_abs"].to_numpy(dtype=float)
+    iv = blk["IV"].to_numpy(dtype=float)
+    strike = blk["strike"].to_numpy(dtype=float)
+    dist = np.abs(d - 0.50)
+
+    def _first_by_exp(key: np.ndarray) -> np.ndarray:
+        # Posición de la primera fila con key mínimo por expiración (-1 si todo NaN)
+        order = np.lexsort((np.arange(n), key, exp_code))
+        starts = np.searchsorted(exp_code[order], np.arange(n_exp), side="left")
+        pos = order[np.minimum(starts, n - 1)]
+        ok = (starts < n) & (exp_code[pos] == np.arange(n_exp)) & ~np.isnan(key[pos])
+        return np.where(ok, pos, -1)
+
+    def _take(values: np.ndarray, pos: np.ndarray) -> np.ndarray:
+        return np.where(pos >= 0, values[np.maximum(pos, 0)], np.nan)
+
+    pos = _first_by_exp(dist)
+    iv_atm = _take(iv, pos)
+    k_atm = _take(strike, pos)
+
+    if ATM_INTERPOLATION:
+        with np.errstate(invalid='ignore'):
+            lo = _first_by_exp(np.where(d <= 0.50, 0.50 - d, np.nan))
+            hi = _first_by_exp(np.where(d >= 0.50, d - 0.50, np.nan))
+            d_lo, d_hi = _take(d, lo), _take(d, hi)
+            w = (0.50 - d_lo) / (d_hi - d_lo)
+            straddle = (lo >= 0) & (hi >= 0) & (d_hi > d_lo)
+            iv_lo, iv_hi = _take(iv, lo), _take(iv, hi)
+            k_lo, k_hi = _take(strike, lo), _take(strike, hi)
+            iv_atm = np.where(straddle, iv_lo + w * (iv_hi - iv_lo), iv_atm)
+            k_atm = np.where(straddle, k_lo + w * (k_hi - k_lo), k_atm)
+
+    dte = (pd.DatetimeIndex(exps).normalize() - day).days.to_numpy()
+    return pd.DataFrame(
+        {"IV_ATM": iv_atm, "K_ATM": k_atm, "dte": dte},
+        index=pd.DatetimeIndex(exps, name="expiration")
+    )
+
+
+def term_atm_30d(atm: pd.DataFrame) -> float:
+    """IV_ATM de la expiración con dte en [20, 40] más cercana a 30 (empate → la primera)"""
+    iv_atm = atm["IV_ATM"].to_numpy(dtype=float)
+    dte = atm["dte"].to_numpy()
+    ok = np.isfinite(iv_atm) & (dte >= 20) & (dte <= 40)
+    if not ok.any():
+        return np.nan
+    cand = np.flatnonzero(ok)
+    return float(iv_atm[cand[np.argmin(np.abs(dte[cand] - 30))]])
+
+
+def assign_bucket_ids(
+    values: np.ndarray,
+    buckets: List[Dict],
+    scale: float = 1.0
+) -> np.ndarray:
+    """
+    ⚡ Índice de bucket de cada valor con np.searchsorted sobre los límites
+
+    Buckets [low, high) contiguos; el último es cerrado [low, high].
+    Devuelve -1 si el valor cae fuera de todos los buckets o es NaN.
+    """
+    v = np.asarray(values, dtype=float)
+    lows = np.array([b["low"] for b in buckets], dtype=float) / scale
+    highs = np.array([b["high"] for b in buckets], dtype=float) / scale
+    last = len(buckets) - 1
+
+    idx = np.searchsorted(lows, v, side="right") - 1
+    safe = np.clip(idx, 0, last)
+    inside = (idx >= 0) & (
+        (v < highs[safe]) | ((safe == last) & (v <= highs[last]))
+    )
+    return np.where(inside, safe, -1)
 
 
-def expand_to_neighbors(
-    bloc_w: pd.DataFrame,
-    db: Dict,
-    tb: Dict,
-    min_required: int = MIN_CONTRACTS_FOR_EXPANSION
+def build_bucket_members(
+    s12: pd.DataFrame,
+    day: pd.Timestamp,
+    atm: pd.DataFrame
 ) -> pd.DataFrame:
     """
-    V18: Expande búsqueda a buckets vecinos si datos insuficientes
+    ⚡ Tabla de pertenencia contrato → bucket (expiración × wing × delta) del día
+
+    Etiqueta cada contrato una sola vez (delta_id / dte_id) y aplica la lógica de
+    expansión a buckets vecinos (V18) a todos los buckets a la vez. Con expansión un contrato
+    puede pertenecer a varios buckets. Devuelve las filas ya filtradas por
+    MIN_PREMIUM y N_MIN_PER_BUCKET, ordenadas por (expiración, P→C, bucket delta)
+    con 'gid' consecutivo por grupo.
     """
-    low_d, high_d = db["low"] / 100.0, db["high"] / 100.0
-    low_t, high_t = tb["low"], tb["high"]
-    
-    if db is DELTA_BUCKETS[-1]:
-        sub = bloc_w.loc[
-            (bloc_w["delta_abs"] >= low_d) & (bloc_w["delta_abs"] <= high_d) &
-            (bloc_w["dte_days"] >= low_t) & (bloc_w["dte_days"] < high_t)
-        ].copy()
+    valid_exps = atm.index[np.isfinite(atm["IV_ATM"]) & np.isfinite(atm["K_ATM"])]
+    blk = s12.loc[s12["right"].isin(["P", "C"]) & s12["expiration"].isin(valid_exps)]
+
+    dte_all = (blk["expiration"].dt.normalize() - day).dt.days.to_numpy(dtype=float)
+    dte_id_all = assign_bucket_ids(dte_all, DTE_BUCKETS)
+    keep = dte_id_all >= 0
+    blk = blk.loc[keep]
+    if blk.empty:
+        return pd.DataFrame()
+
+    dte = dte_all[keep].astype(int)
+    dte_id = dte_id_all[keep]
+    d = blk["delta_abs"].to_numpy(dtype=float)
+    t = blk["dte_days"].to_numpy(dtype=float)
+    n_rows, n_b = len(blk), len(DELTA_BUCKETS)
+
+    delta_id = assign_bucket_ids(d, DELTA_BUCKETS, scale=100.0)
+    base = delta_id[:, None] == np.arange(n_b)[None, :]
+
+    if ENABLE_NEIGHBOR_EXPANSION:
+        low_t = np.array([tb["low"] for tb in DTE_BUCKETS], dtype=float)[dte_id]
+        high_t = np.array([tb["high"] for tb in DTE_BUCKETS], dtype=float)[dte_id]
+        t_core = (t >= low_t) & (t < high_t)
+        base &= t_core[:, None]
+
+        low_d = np.array([db["low"] for db in DELTA_BUCKETS], dtype=float) / 100.0
+        high_d = np.array([db["high"] for db in DELTA_BUCKETS], dtype=float) / 100.0
+        exp_low_d = np.array(
+            [max(0, db["low"] - NEIGHBOR_DELTA_EXPAND) / 100.0 for db in DELTA_BUCKETS]
+        )
+        exp_high_d = np.array(
+            [min(100, db["high"] + NEIGHBOR_DELTA_EXPAND) / 100.0 for db in DELTA_BUCKETS]
+        )
+        t_exp = (t >= np.maximum(1, low_t - NEIGHBOR_DTE_EXPAND)) & (t <= high_t + NEIGHBOR_DTE_EXPAND)
+        expanded = (
+            (d[:, None] >= exp_low_d) & (d[:, None] <= exp_high_d) & t_exp[:, None]
+        )
+
+        # Conteos por (expiración, wing) deciden el modo de cada bucket
+        g, _ = pd.factorize(pd.MultiIndex.from_arrays([blk["expiration"], blk["right"]]))
+        n_g = int(g.max()) + 1
+        cnt_base = np.zeros((n_g, n_b), dtype=np.int64)
+        cnt_exp = np.zeros((n_g, n_b), dtype=np.int64)
+        np.add.at(cnt_base, g, base.astype(np.int64))
+        np.add.at(cnt_exp, g, expanded.astype(np.int64))
+
+        min_req = MIN_CONTRACTS_FOR_EXPANSION
+        use_exp = (cnt_base < min_req) & (cnt_exp >= min_req)
+        use_base = ~use_exp & (cnt_base > 0)
+
+        sel = (use_exp[g] & expanded) | (use_base[g] & base)
+        core = (d[:, None] >= low_d) & (d[:, None] < high_d) & t_core[:, None]
+        level = np.where(use_exp[g] & ~core, 1, 0)
     else:
-        sub = bloc_w.loc[
-            (bloc_w["delta_abs"] >= low_d) & (bloc_w["delta_abs"] < high_d) &
-            (bloc_w["dte_days"] >= low_t) & (bloc_w["dte_days"] < high_t)
-        ].copy()
-    
-    if len(sub) >= min_required:
-        sub['expansion_level'] = 0
-        return sub
-    
-    expanded_low_d = max(0, db["low"] - NEIGHBOR_DELTA_EXPAND) / 100.0
-    expanded_high_d = min(100, db["high"] + NEIGHBOR_DELTA_EXPAND) / 100.0
-    expanded_low_t = max(1, tb["low"] - NEIGHBOR_DTE_EXPAND)
-    expanded_high_t = tb["high"] + NEIGHBOR_DTE_EXPAND
-    
-    sub_expanded = bloc_w.loc[
-        (bloc_w["delta_abs"] >= expanded_low_d) & (bloc_w["delta_abs"] <= expanded_high_d) &
-        (bloc_w["dte_days"] >= expanded_low_t) & (bloc_w["dte_days"] <= expanded_high_t)
-    ].copy()
-    
-    if len(sub_expanded) < min_required:
-        if len(sub) > 0:
-            sub['expansion_level'] = 0
-            return sub
-        else:
-            return pd.DataFrame()
-    
-    sub_expanded['expansion_level'] = 1
-    sub_expanded.loc[
-        (sub_expanded["delta_abs"] >= low_d) & (sub_expanded["delta_abs"] < high_d) &
-        (sub_expanded["dte_days"] >= low_t) & (sub_expanded["dte_days"] < high_t),
-        'expansion_level'
-    ] = 0
-    
-    return sub_expanded
+        sel = base
+        level = np.zeros((n_rows, n_b), dtype=int)
+
+    rr, kk = np.nonzero(sel)
+    if rr.size == 0:
+        return pd.DataFrame()
+
+    exp_code = pd.factorize(blk["expiration"], sort=True)[0]
+    wing_ord = (blk["right"].to_numpy() == "C").astype(int)
+    order = np.lexsort((rr, kk, wing_ord[rr], exp_code[rr]))
+    rr, kk = rr[order], kk[order]
+
+    # Prima mínima y N_MIN_PER_BUCKET por grupo
+    prem_ok = blk["mid"].to_numpy(dtype=float)[rr] >= MIN_PREMIUM
+    rr, kk = rr[prem_ok], kk[prem_ok]
+    if rr.size == 0:
+        return pd.DataFrame()
+
+    new_group = np.ones(rr.size, dtype=bool)
+    new_group[1:] = (
+        (exp_code[rr][1:] != exp_code[rr][:-1]) |
+        (wing_ord[rr][1:] != wing_ord[rr][:-1]) |
+        (kk[1:] != kk[:-1])
+    )
+    gid = np.cumsum(new_group) - 1
+    big = (np.bincount(gid) >= N_MIN_PER_BUCKET)[gid]
+    rr, kk, gid = rr[big], kk[big], gid[big]
+    if rr.size == 0:
+        return pd.DataFrame()
+
+    members = blk.iloc[rr].copy()
+    members["gid"] = pd.factorize(gid)[0]
+    members["delta_id"] = kk
+    members["dte_id"] = dte_id[rr]
+    members["dte"] = dte[rr]
+    members["expansion_level"] = level[rr, kk]
+    members["delta_pct"] = members["delta_abs"] * 100.0
+    return members
+
+
+def select_bucket_leaders(
+    members: pd.DataFrame,
+    spread_med: np.ndarray,
+    day: pd.Timestamp
+) -> Dict[Tuple[pd.Timestamp, str, str, str], Dict]:
+    """
+    ⚡ Contrato líder de cada (día, wing, delta, dte) en una sola pasada
+
+    Puntúa todos los candidatos del día, toma el primer mínimo de score_pick por
+    gid y resuelve cada clave por orden lexicográfico (score, spread, distancia
+    a delta_rep, expiración). El mid 15:30 sale de la columna mid_close.
+    """
+    gid = members["gid"].to_numpy()
+    n = gid.size
+    delta_id = members["delta_id"].to_numpy()
+    dte_id = members["dte_id"].to_numpy()
+
+    rep_d = np.array([db["rep"] for db in DELTA_BUCKETS], dtype=float)[delta_id]
+    width_d = np.array(
+        [max(db["high"] - db["low"], 1e-9) for db in DELTA_BUCKETS], dtype=float
+    )[delta_id]
+    rep_t = np.array([tb["rep"] for tb in DTE_BUCKETS], dtype=float)[dte_id]
+    width_t = np.array(
+        [max(tb["high"] - tb["low"], 1e-9) for tb in DTE_BUCKETS], dtype=float
+    )[dte_id]
+
+    delta_pct = members["delta_pct"].to_numpy(dtype=float)
+    dte = members["dte"].to_numpy(dtype=float)
+    spread = members["spread_pct"].to_numpy(dtype=float)
+
+    score_delta = np.abs(delta_pct - rep_d) / width_d
+    score_dte = np.abs(dte - rep_t) / width_t
+    med = np.asarray(spread_med, dtype=float)[gid]
+    with np.errstate(invalid='ignore'):
+        denom_spread = np.where(med > 1e-6, med, 0.02)
+    score_spread = spread / denom_spread
+
+    score_pick = score_delta + 0.5 * score_dte + 0.5 * score_spread
+
+    # Si hay volumen, priorizar liquidez (volumen máximo por strike dentro del bucket)
+    if "volume" in members.columns:
+        vol = pd.Series(members["volume"].to_numpy(dtype=float))
+        max_vol = vol.groupby(gid).transform("max").to_numpy()
+        vol_k = vol.groupby([gid, members["strike"].to_numpy()], dropna=False).transform("max").to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            score_volume = 1 - (vol_k / max_vol)
+            use_vol = max_vol > 0
+        score_pick = np.where(
+            use_vol,
+            0.4 * score_delta + 0.2 * score_dte + 0.2 * score_spread + 0.2 * score_volume,
+            score_pick
+        )
+
+    # Primer mínimo por gid (NaN al final)
+    order = np.lexsort((np.arange(n), score_pick, gid))
+    first = np.ones(n, dtype=bool)
+    first[1:] = gid[order][1:] != gid[order][:-1]
+    win = order[first]
+    win = win[~np.isnan(score_pick[win])]
+    if win.size == 0:
+        return {}
+
+    # Mejor ganador por clave (wing, delta, dte)
+    wing = (members["right"].to_numpy() == "C").astype(int)
+    dist_rep = np.abs(delta_pct - rep_d)
+    key_order = np.lexsort((
+        gid[win], dist_rep[win], spread[win], score_pick[win],
+        dte_id[win], delta_id[win], wing[win]
+    ))
+    win = win[key_order]
+    k_w, k_d, k_t = wing[win], delta_id[win], dte_id[win]
+    new_key = np.ones(win.size, dtype=bool)
+    new_key[1:] = (k_w[1:] != k_w[:-1]) | (k_d[1:] != k_d[:-1]) | (k_t[1:] != k_t[:-1])
+    best = members.iloc[win[new_key]]
+    best_score = score_pick[win[new_key]]
+    mid1530 = best["mid_close"].to_numpy(dtype=float)
+
+    leader_local: Dict[Tuple[pd.Timestamp, str, str, str], Dict] = {}
+    for i, row in enumerate(best.itertuples(index=False)):
+        key = (
+            day, "PUT" if row.right == "P" else "CALL",
+            DELTA_BUCKETS[row.delta_id]["code"], DTE_BUCKETS[row.dte_id]["code"]
+        )
+        leader_local[key] = {
+            "strike": float(row.strike),
+            "dte": int(row.dte),
+            "score_pick": float(best_score[i]),
+            "spread_pct": float(row.spread_pct),
+            "delta_pct": float(row.delta_pct),
+            "bid10": float(row.bid) if pd.notna(row.bid) else np.nan,
+            "ask10": float(row.ask) if pd.notna(row.ask) else np.nan,
+            "mid10": float(row.mid) if pd.notna(row.mid) else np.nan,
+            "mid1530": float(mid1530[i]) if pd.notna(mid1530[i]) else np.nan,
+        }
+    return leader_local
 
 
 # ============================= PERCENTILES CON CALENDARIO UNIVERSAL =============================
 
-def rolling_percentile_with_universal_calendar(
-    df: pd.DataFrame,
-    col: str,
-    window_days: int,
-    full_trading_calendar: pd.DatetimeIndex,
-    min_coverage: float = MIN_PERCENTILE_COVERAGE
-) -> pd.Series:
+def _real_data_flags(df_work: pd.DataFrame, for_percentile: bool = True) -> Tuple[np.ndarray, np.ndarray]:
     """
-    🔥 V18: Percentiles sobre CALENDARIO UNIVERSAL USA
+    Flags de dato real: (cuenta para la ventana, fila evaluable)
     
-    Garantiza que todos los buckets usan el mismo calendario,
-    haciendo los percentiles comparables entre sí.
+    En la ventana solo cuentan filas con flag == True; la fila actual solo se
+    descarta si su flag es falso (NaN cuenta como real, igual que `not is_real`).
+    Sin IS_REAL_DATA los percentiles usan ~IS_FORWARD_FILLED; la cobertura, True.
     """
-    if df.empty or col not in df.columns:
-        return pd.Series([np.nan] * len(df), index=df.index)
-    
-    df_work = df.sort_values('date').reset_index(drop=True).copy()
-    
     if 'IS_REAL_DATA' in df_work.columns:
-        df_work['_is_real'] = df_work['IS_REAL_DATA']
-    elif 'IS_FORWARD_FILLED' in df_work.columns:
-        df_work['_is_real'] = ~df_work['IS_FORWARD_FILLED']
+        flag = df_work['IS_REAL_DATA']
+    elif for_percentile and 'IS_FORWARD_FILLED' in df_work.columns:
+        flag = ~df_work['IS_FORWARD_FILLED']
     else:
-        df_work['_is_real'] = df_work[col].notna()
-    
-    result = []
-    min_required = max(int(window_days * min_coverage), 5)
-    
-    for idx in range(len(df_work)):
-        current_value = df_work.loc[idx, col]
-        current_date = pd.to_datetime(df_work.loc[idx, 'date']).normalize()
-        is_real = df_work.loc[idx, '_is_real']
-        
-        if pd.isna(current_value) or not is_real:
-            result.append(np.nan)
-            continue
-        
-        calendar_before_today = full_trading_calendar[full_trading_calendar < current_date]
-        
-        if len(calendar_before_today) < window_days:
-            result.append(np.nan)
-            continue
-        
-        window_dates = calendar_before_today[-window_days:]
-        
-        mask = (
-            (df_work['date'].isin(window_dates)) &
-            (df_work['_is_real'] == True) &
-            (df_work[col].notna())
-        )
-        
-        historical = df_work.loc[mask, col]
+        # Sin flags: los percentiles ya exigen valor no nulo, equivalente a col.notna()
+        flag = pd.Series(True, index=df_work.index)
+    in_window = (flag == True).to_numpy(dtype=bool)
+    current_ok = flag.fillna(True).astype(bool).to_numpy()
+    return in_window, current_ok
 
-        if len(historical) < min_required:
-            result.append(np.nan)
-            continue
 
-        # 🔥 V20 FIX #1: Percentil empírico corregido usando scipy
-        # Antes: (historical < current_value).sum() / len(historical)
-        # Problema: Sesgo sistemático de ~12.5% en extremos
-        # Ahora: percentileofscore con método 'mean' (estándar estadístico)
-        percentile = percentileofscore(historical.values, current_value, kind='mean') / 100.0
-        result.append(percentile)
+def plan_calendar_windows(
+    df: pd.DataFrame,
+    full_trading_calendar: TradingCalendar,
+    windows: List[int]
+) -> Dict:
+    """
+    ⚡ Planificador de ventanas de calendario de un bucket, compartido por métricas y W
     
-    return pd.Series(result, index=df_work.index)
+    Calcula una sola vez la posición de calendario de cada fila, las filas que
+    pueden entrar en una ventana (en calendario y reales, en orden de fecha) y,
+    para cada W, los límites [lo, hi) de la ventana de cada fila sobre ellas.
+    """
+    in_window, current_ok = _real_data_flags(df, for_percentile=True)
+    p_now, _ = full_trading_calendar.positions(pd.to_datetime(df['date']).dt.normalize())
+    p_row, in_cal = full_trading_calendar.positions(df['date'])
+    
+    order = np.argsort(p_row, kind="stable")
+    members = order[(in_cal & in_window)[order]]
+    m_pos = p_row[members]
+    
+    bounds = {
+        W: (np.searchsorted(m_pos, p_now - W, side="left"),
+            np.searchsorted(m_pos, p_now, side="left"))
+        for W in windows
+    }
+    return {"members": members, "p_now": p_now, "current_ok": current_ok, "bounds": bounds}
 
 
-def calculate_coverage_metrics(
-    df: pd.DataFrame,
+def calendar_percentiles_2d(
+    values: np.ndarray,
+    plan: Dict,
     window_days: int,
-    full_trading_calendar: pd.DatetimeIndex
-) -> pd.Series:
-    """
-    V18: Calcula métricas de cobertura temporal
+    min_coverage: float = MIN_PERCENTILE_COVERAGE
+) -> np.ndarray:
     """
-    if df.empty:
-        return pd.Series([np.nan] * len(df), index=df.index)
+    ⚡ Percentil kind='mean' de varias métricas (filas de values) contra las
+    ventanas ya planificadas para window_days
     
-    df_work = df.sort_values('date').reset_index(drop=True).copy()
-    
-    if 'IS_REAL_DATA' in df_work.columns:
-        df_work['_is_real'] = df_work['IS_REAL_DATA']
-    else:
-        df_work['_is_real'] = True
+    Por métrica, ventana ordenada deslizante (bisect) sobre los miembros del
+    plan: cada percentil cuesta O(log W). NaN no cuenta en la ventana.
+    Mismo cálculo que scipy.stats.percentileofscore(kind='mean') / 100.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    result = np.full(values.shape, np.nan)
     
-    result = []
+    members = plan["members"]
+    lo_all, hi_all = plan["bounds"][window_days]
+    min_required = max(int(window_days * min_coverage), 5)
     
-    for idx in range(len(df_work)):
-        current_date = pd.to_datetime(df_work.loc[idx, 'date']).normalize()
-        
-        calendar_before_today = full_trading_calendar[full_trading_calendar < current_date]
-        
-        if len(calendar_before_today) < window_days:
-            result.append(np.nan)
-            continue
-        
-        window_dates = calendar_before_today[-window_days:]
-        
-        n_with_data = df_work.loc[
-            (df_work['date'].isin(window_dates)) & (df_work['_is_real'] == True)
-        ].shape[0]
-        
-        coverage = n_with_data / window_days
-        result.append(coverage)
+    # Filas evaluables en orden de calendario: los límites solo avanzan
+    query = np.flatnonzero((plan["p_now"] >= window_days) & plan["current_ok"])
+    query = query[np.argsort(plan["p_now"][query], kind="stable")]
+    steps = list(zip(query.tolist(), lo_all[query].tolist(), hi_all[query].tolist()))
+    
+    for k, vals in enumerate(values):
+        member_vals = vals[members].tolist()
+        window: List[float] = []
+        lo = hi = 0
+        for i, new_lo, new_hi in steps:
+            while hi < new_hi:
+                v = member_vals[hi]
+                if v == v:
+                    bisect.insort(window, v)
+                hi += 1
+            while lo < new_lo:
+                v = member_vals[lo]
+                if v == v:
+                    del window[bisect.bisect_left(window, v)]
+                lo += 1
+            
+            x = vals[i]
+            n = len(window)
+            if x != x or n < min_required:
+                continue
+            
+            # 🔥 V20 FIX #1: Percentil empírico con método 'mean' (mismo cálculo que
+            # scipy.stats.percentileofscore(kind='mean'))
+            left = bisect.bisect_left(window, x)
+            right = bisect.bisect_right(window, x)
+            result[k, i] = (left + right) * (50.0 / n) / 100.0
     
-    return pd.Series(result, index=df_work.index)
+    return result
 
 
-# ============================= SKEW ROBUSTO =============================
-
-def calculate_robust_skew(
-    sub_df: pd.DataFrame,
-    iv_atm: float,
-    k_atm: float,
-    wing: str,
-    method: str = 'robust'
-) -> pd.Series:
+def calculate_coverage_all_windows(
+    df: pd.DataFrame,
+    windows: List[int],
+    full_trading_calendar: TradingCalendar,
+    group_cols: Optional[List[str]] = None
+) -> pd.DataFrame:
     """
-    V18: Cálculo de SKEW más robusto usando regresión
+    ⚡ coverage_{W}D de todos los buckets y ventanas en una sola llamada
+    
+    Conteo acumulado de filas reales por posición de calendario en una matriz
+    [bucket, calendario]; cada cobertura es una resta de prefijos (O(n)).
+    Devuelve un DataFrame alineado con df.index. group_cols=[] → un único bucket.
     """
-    if sub_df.empty or pd.isna(iv_atm) or pd.isna(k_atm):
-        return pd.Series([np.nan] * len(sub_df), index=sub_df.index)
+    if group_cols is None:
+        group_cols = ["wing", "delta_code", "dte_code"]
     
-    sub_df = sub_df.copy()
+    out = pd.DataFrame(index=df.index)
+    if df.empty:
+        for W in windows:
+            out[f"coverage_{W}D"] = np.nan
+        return out
     
-    if wing == "P":
-        sub_df['ln_moneyness'] = np.log(k_atm / sub_df["strike"].astype(float))
+    if group_cols:
+        b_id = df.groupby(group_cols, sort=False, dropna=False).ngroup().to_numpy()
     else:
-        sub_df['ln_moneyness'] = np.log(sub_df["strike"].astype(float) / k_atm)
+        b_id = np.zeros(len(df), dtype=np.int64)
     
-    sub_df = sub_df[sub_df['ln_moneyness'].abs() > LN_RATIO_EPS].copy()
+    in_window, _ = _real_data_flags(df, for_percentile=False)
+    p_now, _ = full_trading_calendar.positions(pd.to_datetime(df['date']).dt.normalize())
+    p_row, in_cal = full_trading_calendar.positions(df['date'])
     
-    if len(sub_df) < 3:
-        return pd.Series([np.nan] * len(sub_df), index=sub_df.index)
+    # counts[b, k + 1] = filas reales del bucket b en la posición k; cumsum → prefijos
+    counts = np.zeros((int(b_id.max()) + 1, len(full_trading_calendar) + 1), dtype=np.int32)
+    ok = in_cal & in_window
+    np.add.at(counts, (b_id[ok], p_row[ok] + 1), 1)
+    prefix = np.cumsum(counts, axis=1)
     
-    if method == 'robust':
-        X = sub_df['ln_moneyness'].values
-        Y = (sub_df['IV'].values - iv_atm)
-        
-        if len(X) >= 2:
-            coef = np.polyfit(X, Y, deg=1)
-            slope = coef[0]
-            return pd.Series([slope] * len(sub_df), index=sub_df.index)
-        else:
-            return pd.Series([np.nan] * len(sub_df), index=sub_df.index)
+    for W in windows:
+        n_with_data = prefix[b_id, p_now] - prefix[b_id, np.maximum(p_now - W, 0)]
+        out[f"coverage_{W}D"] = np.where(p_now >= W, n_with_data / W, np.nan)
     
-    else:
-        num = (sub_df["IV"] - iv_atm)
-        with np.errstate(divide='ignore', invalid='ignore'):
-            skew_norm_each = num / sub_df['ln_moneyness']
-        return skew_norm_each
+    return out
+
+
+# ============================= SKEW ROBUSTO =============================
+
+def calculate_robust_skew_grouped(
+    members: pd.DataFrame,
+    atm: pd.DataFrame
+) -> np.ndarray:
+    """
+    ⚡ V18: SKEW robusto = pendiente OLS de (IV - IV_ATM) sobre ln(moneyness) para todos los grupos
+
+    Forma cerrada con estadísticos suficientes (Σx, Σy, Σxy, Σx²) por gid.
+    Filtro LN_RATIO_EPS y mínimo de 3 puntos; NaN si ln_moneyness no varía.
+    """
+    gid = members["gid"].to_numpy()
+    n_groups = int(gid.max()) + 1
+
+    exp = members["expiration"]
+    iv_atm = exp.map(atm["IV_ATM"]).to_numpy(dtype=float)
+    k_atm = exp.map(atm["K_ATM"]).to_numpy(dtype=float)
+    strike = members["strike"].to_numpy(dtype=float)
+    is_put = (members["right"] == "P").to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ln_m = np.where(is_put, np.log(k_atm / strike), np.log(strike / k_atm))
+    ok = np.abs(ln_m) > LN_RATIO_EPS
+
+    g = gid[ok]
+    x = ln_m[ok]
+    y = members["IV"].to_numpy(dtype=float)[ok] - iv_atm[ok]
+
+    n = np.bincount(g, minlength=n_groups).astype(float)
+    sx = np.bincount(g, weights=x, minlength=n_groups)
+    sy = np.bincount(g, weights=y, minlength=n_groups)
+    sxy = np.bincount(g, weights=x * y, minlength=n_groups)
+    sxx = np.bincount(g, weights=x * x, minlength=n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        den = sxx - sx * sx / n
+        num = sxy - sx * sy / n
+        valid = (n >= 3) & (den > 1e-12 * sxx)
+        return np.where(valid, num / den, np.nan)
 
 
 # ============================= VALIDACIONES =============================
@@ -748,90 +1154,237 @@ def check_butterfly_arbitrage(
 
 # ============================= FORWARD-FILL CONTROLADO (V18.1 FIXED) =============================
 
+FFILL_BUCKET_KEYS = ['wing', 'delta_code', 'dte_code']
+
+# Columnas críticas a forward-fill
+FFILL_COLUMNS = [
+    'wing', 'delta_code', 'delta_rep', 'delta_low', 'delta_high',
+    'dte_code', 'dte_rep', 'dte_low', 'dte_high',
+    'IV_bucket', 'IV_ATM_bucket', 'SKEW_NORM_bucket', 'TERM_bucket',
+    'spread_pct_med', 'spot', 'delta_med_in_bucket', 'dte_med_in_bucket',
+    'N', 'N_exps', 'PNL_SHORT_bucket',
+    'HV_7D_VOL', 'HV_21D_VOL', 'HV_63D_VOL', 'HV_252D_VOL',
+    'HV_7D_VOL_Tminus1', 'VRP_7D_VOL', 'VRP_7D_VAR',
+    'interpolation_quality', 'n_contracts_used'
+]
+
+# Métricas que pueden faltar en una fila real: su ffill no arranca
+# necesariamente en la última fila real del bucket
+FFILL_SPARSE_COLUMNS = [
+    'IV_ATM_bucket', 'SKEW_NORM_bucket', 'TERM_bucket', 'spread_pct_med', 'spot',
+    'PNL_SHORT_bucket',
+    'HV_7D_VOL', 'HV_21D_VOL', 'HV_63D_VOL', 'HV_252D_VOL',
+    'HV_7D_VOL_Tminus1', 'VRP_7D_VOL', 'VRP_7D_VAR'
+]
+
+# Bit i → FFILL_SPARSE_COLUMNS[i] rellenada por el ffill en esa fila (no es dato original)
+SPARSE_FILL_MASK_COL = 'FFILL_SPARSE_MASK'
+
+
+def sparse_fill_cells(df: pd.DataFrame, calendar: Optional[TradingCalendar] = None) -> pd.DataFrame:
+    """
+    Celdas de FFILL_SPARSE_COLUMNS que son relleno del ffill, no dato original
+    
+    Se leen de SPARSE_FILL_MASK_COL. Las filas sin máscara (superficies de
+    versiones anteriores) se estiman: la celda que repite el valor del día
+    trading anterior del bucket se toma como relleno.
+    """
+    cols = [c for c in FFILL_SPARSE_COLUMNS if c in df.columns]
+    bit = np.array([FFILL_SPARSE_COLUMNS.index(c) for c in cols], dtype=np.int64)
+    stored = df[SPARSE_FILL_MASK_COL] if SPARSE_FILL_MASK_COL in df.columns else pd.Series(np.nan, index=df.index)
+    has_mask = stored.notna().to_numpy()
+    bits = stored.fillna(0).to_numpy(dtype=np.int64)
+    filled = ((bits[:, None] >> bit[None, :]) & 1).astype(bool)
+    
+    if not has_mask.all():
+        if calendar is None:
+            calendar = get_trading_calendar(df['date'].min(), df['date'].max())
+        srt = df.sort_values(FFILL_BUCKET_KEYS + ['date'], kind='stable')
+        pos, _ = calendar.positions(srt['date'])
+        groups = srt.groupby(FFILL_BUCKET_KEYS, sort=False)
+        prev_day = np.zeros(len(srt), dtype=bool)
+        prev_day[1:] = (np.diff(pos) == 1)
+        prev_day &= (groups.cumcount() > 0).to_numpy()
+        repeated = (srt[cols] == groups[cols].shift(1)) & prev_day[:, None]
+        repeated = repeated.reindex(df.index).to_numpy()
+        filled[~has_mask] = repeated[~has_mask]
+    
+    return pd.DataFrame(filled, index=df.index, columns=cols)
+
+
+def sparse_fill_mask(filled: pd.DataFrame) -> np.ndarray:
+    """Codifica las celdas rellenas (sparse_fill_cells) en SPARSE_FILL_MASK_COL"""
+    bit = np.array([FFILL_SPARSE_COLUMNS.index(c) for c in filled.columns], dtype=np.int64)
+    return (filled.to_numpy().astype(np.int64) << bit[None, :]).sum(axis=1)
+
+
+def label_data_quality(
+    is_real: np.ndarray,
+    segment_start: np.ndarray,
+    max_ffill_days: int = MAX_FFILL_DAYS
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    DAYS_SINCE_REAL_DATA y DATA_QUALITY vectorizados
+    
+    El contador se reinicia en cada dato real y al inicio de cada bucket
+    (segment_start); si el bucket no empieza con dato real, cuenta desde 1.
+    """
+    n = len(is_real)
+    resets = is_real | segment_start
+    run_id = np.cumsum(resets) - 1
+    run_start = np.flatnonzero(resets)
+    anchor = run_start - (~is_real[run_start]).astype(np.int64)
+    days = np.arange(n, dtype=np.int64) - anchor[run_id]
+    
+    quality = np.select(
+        [is_real, days <= 5, days <= 15, days <= max_ffill_days],
+        ['REAL', 'HIGH', 'MEDIUM', 'LOW'],
+        default='STALE'
+    ).astype(object)
+    return days, quality
+
+
 def reindex_and_ffill_controlled(
-    df_bucket: pd.DataFrame,
+    df: pd.DataFrame,
     start_date: pd.Timestamp,
     end_date: pd.Timestamp,
-    max_ffill_days: int = MAX_FFILL_DAYS
+    max_ffill_days: int = MAX_FFILL_DAYS,
+    calendar: Optional[TradingCalendar] = None
 ) -> pd.DataFrame:
     """
     🔧 V18.1: Forward-fill controlado con límites y calidad
     
     FIX CRÍTICO: No reindexea antes del primer dato real del bucket.
     Esto evita crear filas fantasma vacías al inicio.
+    
+    ⚡ Todos los buckets a la vez sobre una rejilla (bucket, día trading):
+    un único reindex, ffill agrupado con límite y calidad vectorizada.
+    Las filas salen agrupadas por bucket en el orden de groupby.
     """
-    if df_bucket.empty:
-        return df_bucket
+    if df.empty:
+        return df
     
-    # 🔥 FIX: Usar rango real del bucket, no calendario completo
-    bucket_start = df_bucket['date'].min()
-    bucket_end = df_bucket['date'].max()
+    df = df.reset_index(drop=True)
+    bucket = df.groupby(FFILL_BUCKET_KEYS).ngroup().to_numpy()
+    df = df[bucket >= 0]
+    bucket = bucket[bucket >= 0]
+    dates = pd.DatetimeIndex(df['date'])
     
-    # Ajustar start_date para no crear filas vacías al inicio
-    effective_start = max(start_date, bucket_start)
-    effective_end = max(end_date, bucket_end)
+    # 🔥 FIX: Usar rango real del bucket, no calendario completo
+    bounds = pd.DataFrame({'bucket': bucket, 'date': dates}).groupby('bucket')['date'].agg(['min', 'max'])
+    effective_start = np.maximum(bounds['min'].to_numpy(), np.datetime64(start_date, 'ns'))
+    effective_end = np.maximum(bounds['max'].to_numpy(), np.datetime64(end_date, 'ns'))
+    
+    # Crear índice completo de días trading solo en el rango efectivo de cada bucket
+    if calendar is None:
+        calendar = get_trading_calendar(effective_start.min(), effective_end.max())
+    trading_days = calendar.range(effective_start.min(), effective_end.max())
+    lo = trading_days.searchsorted(effective_start, side='left')
+    hi = trading_days.searchsorted(effective_end, side='right')
+    lengths = hi - lo
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    
+    grid_bucket = np.repeat(np.arange(len(lengths)), lengths)
+    grid_pos = np.arange(len(grid_bucket)) - offsets[grid_bucket] + lo[grid_bucket]
+    
+    # Reindexar: fila origen de cada celda de la rejilla (-1 → hueco)
+    pos = np.minimum(trading_days.searchsorted(dates), len(trading_days) - 1)
+    matched = (
+        (trading_days[pos] == dates) & (pos >= lo[bucket]) & (pos < hi[bucket])
+    )
+    source = np.full(len(grid_bucket), -1, dtype=np.int64)
+    source[offsets[bucket[matched]] + pos[matched] - lo[bucket[matched]]] = df.index.to_numpy()[matched]
     
-    # Crear índice completo de días trading solo en el rango efectivo
-    full_trading_days = get_trading_days(effective_start, effective_end)
+    grid = df.drop(columns='date').reindex(source).reset_index(drop=True)
+    grid.insert(0, 'date', trading_days[grid_pos])
     
-    # Reindexar
-    df_bucket = df_bucket.set_index('date').reindex(full_trading_days).reset_index()
-    df_bucket = df_bucket.rename(columns={'index': 'date'})
-
     # ✅ FIX #4 (V22): Preservar IS_REAL_DATA durante reindex
-    # En modo incremental, df_bucket ya tiene IS_REAL_DATA de existing_surface
+    # En modo incremental, df ya tiene IS_REAL_DATA de existing_surface
     # Solo marcar nuevos datos si la columna no existe (primera vez)
-    if 'IS_REAL_DATA' not in df_bucket.columns:
+    if 'IS_REAL_DATA' not in grid.columns:
         # Primera vez (modo full): marcar basado en IV
-        df_bucket['IS_REAL_DATA'] = df_bucket['IV_bucket'].notna()
+        grid['IS_REAL_DATA'] = grid['IV_bucket'].notna()
     else:
         # Modo incremental: preservar flags existentes
         # Nuevas filas del reindex (NaN) se marcan como False (se forward-fillearán)
-        df_bucket['IS_REAL_DATA'] = df_bucket['IS_REAL_DATA'].fillna(False)
-    
-    # Columnas críticas a forward-fill
-    ffill_cols = [
-        'wing', 'delta_code', 'delta_rep', 'delta_low', 'delta_high',
-        'dte_code', 'dte_rep', 'dte_low', 'dte_high',
-        'IV_bucket', 'IV_ATM_bucket', 'SKEW_NORM_bucket', 'TERM_bucket',
-        'spread_pct_med', 'spot', 'delta_med_in_bucket', 'dte_med_in_bucket',
-        'N', 'N_exps', 'PNL_SHORT_bucket',
-        'HV_7D_VOL', 'HV_21D_VOL', 'HV_63D_VOL', 'HV_252D_VOL',
-        'HV_7D_VOL_Tminus1', 'VRP_7D_VOL', 'VRP_7D_VAR',
-        'interpolation_quality', 'n_contracts_used'
-    ]
+        grid['IS_REAL_DATA'] = grid['IS_REAL_DATA'].fillna(False).astype(bool)
     
-    # Forward-fill CON LÍMITE
-    for col in ffill_cols:
-        if col in df_bucket.columns:
-            df_bucket[col] = df_bucket[col].ffill(limit=max_ffill_days)
+    # Forward-fill CON LÍMITE (por bucket)
+    ffill_cols = [c for c in FFILL_COLUMNS if c in grid.columns]
+    sparse_cols = [c for c in FFILL_SPARSE_COLUMNS if c in grid.columns]
+    was_missing = grid[sparse_cols].isna()
+    grid[ffill_cols] = grid[ffill_cols].groupby(grid_bucket).ffill(limit=max_ffill_days)
+    grid[SPARSE_FILL_MASK_COL] = sparse_fill_mask(was_missing & grid[sparse_cols].notna())
     
     # Calcular días desde último dato real y calidad
-    df_bucket['DAYS_SINCE_REAL_DATA'] = 0
-    df_bucket['DATA_QUALITY'] = 'REAL'
-    
-    days_count = 0
-    for idx in range(len(df_bucket)):
-        if df_bucket.loc[idx, 'IS_REAL_DATA']:
-            days_count = 0
-            quality = 'REAL'
-        else:
-            days_count += 1
-            if days_count <= 5:
-                quality = 'HIGH'
-            elif days_count <= 15:
-                quality = 'MEDIUM'
-            elif days_count <= max_ffill_days:
-                quality = 'LOW'
-            else:
-                quality = 'STALE'
-        
-        df_bucket.at[idx, 'DAYS_SINCE_REAL_DATA'] = days_count
-        df_bucket.at[idx, 'DATA_QUALITY'] = quality
+    is_real = grid['IS_REAL_DATA'].to_numpy()
+    segment_start = np.zeros(len(grid), dtype=bool)
+    segment_start[offsets[lengths > 0]] = True
     
-    df_bucket['IS_FORWARD_FILLED'] = ~df_bucket['IS_REAL_DATA']
+    grid['DAYS_SINCE_REAL_DATA'], grid['DATA_QUALITY'] = label_data_quality(
+        is_real, segment_start, max_ffill_days
+    )
+    grid['IS_FORWARD_FILLED'] = ~is_real
     
-    return df_bucket
+    return grid
+
+
+def extend_ffill_incremental(
+    df: pd.DataFrame,
+    since: pd.Timestamp,
+    end_date: pd.Timestamp,
+    max_ffill_days: int = MAX_FFILL_DAYS,
+    calendar: Optional[TradingCalendar] = None
+) -> pd.DataFrame:
+    """
+    ⚡ Forward-fill incremental: solo se regeneran los días >= since
+    
+    Las filas históricas (< since) quedan intactas. Cada bucket se reindexa
+    desde su última fila real anterior a since junto con las filas reales de
+    los últimos max_ffill_days días trading (las únicas cuyo relleno puede
+    llegar a since). En esas filas, las celdas de FFILL_SPARSE_COLUMNS que
+    son relleno (sparse_fill_cells) se vacían: el límite cuenta desde el dato
+    original como en modo full y las columnas ya agotadas no se vuelven a
+    sembrar.
+    """
+    if calendar is None:
+        calendar = get_trading_calendar(df['date'].min(), end_date)
+    
+    is_real = (df['IS_REAL_DATA'] == True).to_numpy()
+    history = (df['date'] < since).to_numpy()
+    filled = sparse_fill_cells(df, calendar)
+    
+    hist = df[history].sort_values(FFILL_BUCKET_KEYS + ['date'], kind='stable')
+    pos, _ = calendar.positions(hist['date'])
+    since_pos = calendar.positions([since])[0][0]
+    hist_real = (hist['IS_REAL_DATA'] == True).to_numpy()
+    
+    last_real_idx = hist[hist_real].groupby(FFILL_BUCKET_KEYS, sort=False).tail(1).index
+    keep = hist_real & ((pos >= since_pos - max_ffill_days) | hist.index.isin(last_real_idx))
+    
+    # Semillas y filas reales >= since ya guardadas (fichero reprocesado) vuelven sin relleno
+    to_fill = pd.concat([hist[keep], df[~history & is_real]])
+    to_fill[filled.columns] = to_fill[filled.columns].mask(filled.loc[to_fill.index])
+    to_fill = to_fill.reset_index(drop=True)
+    seeds = int(keep.sum())
+    # Superficies sin máscara: se guarda la estimada para las filas históricas
+    hist_rows = df[history].assign(**{SPARSE_FILL_MASK_COL: sparse_fill_mask(filled[history])})
+    if to_fill.empty:
+        return hist_rows
+    
+    extended = reindex_and_ffill_controlled(
+        to_fill, to_fill['date'].min(), end_date, max_ffill_days, calendar=calendar
+    )
+    extended = extended[extended['date'] >= since]
+    
+    logger.info(
+        f"   Incremental desde {since.date()}: {seeds:,} filas semilla "
+        f"({len(last_real_idx):,} buckets), {len(extended):,} filas regeneradas"
+    )
+    out = pd.concat([hist_rows, extended], ignore_index=True)
+    # Las filas nuevas llegan sin contador (NaN antes del concat): mismo dtype que en modo full
+    out['DAYS_SINCE_REAL_DATA'] = out['DAYS_SINCE_REAL_DATA'].astype(np.int64)
+    return out
 
 
 def remove_empty_rows(df: pd.DataFrame) -> pd.DataFrame:
@@ -1004,109 +1557,259 @@ def print_quality_report(report: Dict):
 
 # ============================= CÁLCULO DE PERCENTILES Y MÉTRICAS =============================
 
-def calculate_bucket_percentiles(
-    df: pd.DataFrame,
-    full_trading_calendar: pd.DatetimeIndex
+PERCENTILE_GROUP_KEYS = ["wing", "delta_code", "dte_code"]
+
+# Columnas que produce la etapa de percentiles (se descartan antes de recalcular)
+PERCENTILE_OUTPUT_RE = re.compile(
+    r"(IV|SKEW|VRP)_pct_\d+|coverage_\d+D|SCORE_SIMPLE_\d+|LEVEL10_SIMPLE_\d+N?|LABEL10_SIMPLE_\d+"
+)
+SKEW_Z_STATE_ROWS = 62  # Filas reales previas que necesita la ventana SKEW_Z63 (63 - 1)
+
+
+def _bucket_percentile_frame(
+    g: pd.DataFrame,
+    cov_gg: pd.DataFrame,
+    full_trading_calendar: TradingCalendar
 ) -> pd.DataFrame:
     """
-    V18: Cálculo de percentiles con calendario universal
-    """
-    logger.info("📊 Calculando percentiles sobre CALENDARIO UNIVERSAL USA...")
+    SKEW z-score, percentiles, coberturas y scores de un bucket
     
+    g debe venir ordenado por fecha; cov_gg son sus coberturas en el mismo orden.
+    """
     w_iv, w_sk, w_vrp = SCORE_WEIGHTS
-    out_frames = []
     
-    total_buckets = df.groupby(["wing", "delta_code", "dte_code"]).ngroups
-    logger.info(f"   Buckets a procesar: {total_buckets}")
+    gg = g.copy()
+    
+    gg_real = gg[gg['IS_REAL_DATA'] == True].copy() if 'IS_REAL_DATA' in gg.columns else gg.copy()
     
-    iterator = df.groupby(["wing", "delta_code", "dte_code"], sort=False)
-    if _tqdm:
-        iterator = _tqdm(iterator, total=total_buckets, desc="Percentiles")
+    # En modo incremental gg es solo la cola del bucket: el tamaño de ventana
+    # se decide con el nº de filas reales de todo su histórico
+    n_real = int(gg['_N_REAL_HISTORY'].iloc[0]) if '_N_REAL_HISTORY' in gg.columns else len(gg_real)
     
-    for (wing, dcode, tcode), g in iterator:
-        gg = g.sort_values("date").copy()
+    if n_real >= 20:
+        win_sk = min(63, n_real // 2)
+        skew_sma = gg_real["SKEW_NORM_bucket"].rolling(win_sk, min_periods=max(10, win_sk // 3)).mean()
+        skew_sd = gg_real["SKEW_NORM_bucket"].rolling(win_sk, min_periods=max(10, win_sk // 3)).std()
         
-        gg_real = gg[gg['IS_REAL_DATA']].copy() if 'IS_REAL_DATA' in gg.columns else gg.copy()
+        gg_real["SKEW_SMA63"] = skew_sma
+        gg_real["SKEW_SD63"] = skew_sd
         
-        if len(gg_real) >= 20:
-            win_sk = min(63, len(gg_real) // 2)
-            skew_sma = gg_real["SKEW_NORM_bucket"].rolling(win_sk, min_periods=max(10, win_sk // 3)).mean()
-            skew_sd = gg_real["SKEW_NORM_bucket"].rolling(win_sk, min_periods=max(10, win_sk // 3)).std()
-            
-            gg_real["SKEW_SMA63"] = skew_sma
-            gg_real["SKEW_SD63"] = skew_sd
-            
-            with np.errstate(divide='ignore', invalid='ignore'):
-                gg_real["SKEW_Z63"] = np.where(
-                    skew_sd > 0,
-                    (gg_real["SKEW_NORM_bucket"] - skew_sma) / skew_sd,
-                    np.nan
-                )
-            
-            gg_real["SKEW_Z63_txt"] = gg_real["SKEW_Z63"].apply(
-                lambda z: f"{z:.2f}σ" if pd.notna(z) else ""
-            )
-            
-            gg = gg.merge(
-                gg_real[['date', 'SKEW_SMA63', 'SKEW_SD63', 'SKEW_Z63', 'SKEW_Z63_txt']],
-                on='date',
-                how='left',
-                suffixes=('', '_new')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gg_real["SKEW_Z63"] = np.where(
+                skew_sd > 0,
+                (gg_real["SKEW_NORM_bucket"] - skew_sma) / skew_sd,
+                np.nan
             )
-            
-            for col in ['SKEW_SMA63', 'SKEW_SD63', 'SKEW_Z63', 'SKEW_Z63_txt']:
-                if f'{col}_new' in gg.columns:
-                    gg[col] = gg[f'{col}_new'].combine_first(gg.get(col, pd.Series()))
-                    gg = gg.drop(columns=[f'{col}_new'])
         
-        delta_rep_bucket = float(gg["delta_rep"].iloc[0])
-        is_atmish = (40.0 <= delta_rep_bucket <= 60.0)
+        gg_real["SKEW_Z63_txt"] = gg_real["SKEW_Z63"].apply(
+            lambda z: f"{z:.2f}σ" if pd.notna(z) else ""
+        )
+        
+        gg = gg.merge(
+            gg_real[['date', 'SKEW_SMA63', 'SKEW_SD63', 'SKEW_Z63', 'SKEW_Z63_txt']],
+            on='date',
+            how='left',
+            suffixes=('', '_new')
+        )
         
-        for W in WINDOWS:
-            gg[f"IV_pct_{W}"] = rolling_percentile_with_universal_calendar(
-                gg, "IV_bucket", window_days=W,
-                full_trading_calendar=full_trading_calendar
-            )
-            
-            gg[f"coverage_{W}D"] = calculate_coverage_metrics(
-                gg, window_days=W,
-                full_trading_calendar=full_trading_calendar
-            )
-            
-            gg[f"SKEW_pct_{W}"] = rolling_percentile_with_universal_calendar(
-                gg, "SKEW_NORM_bucket", window_days=W,
-                full_trading_calendar=full_trading_calendar
-            )
-            
-            gg[f"VRP_pct_{W}"] = rolling_percentile_with_universal_calendar(
-                gg, "VRP_7D_VOL", window_days=W,
-                full_trading_calendar=full_trading_calendar
-            )
-            
-            # 🔥 V20 FIX #2: Scores unificados con pesos consistentes
-            # Antes: ATM usaba pesos renormalizados (92.3% IV, 7.7% VRP, 0% SKEW)
-            #        OTM usaba pesos nominales (60% IV, 35% SKEW, 5% VRP)
-            # Problema: Scores ATM y OTM no comparables (diferentes escalas)
-            # Ahora: Pesos consistentes para todos los buckets
-            #        Para ATM: SKEW_pct se rellena con 0.5 (neutral) si es NaN
-
-            # Rellenar SKEW_pct con 0.5 (neutral) para buckets ATM donde puede ser NaN
-            skew_pct_filled = gg[f"SKEW_pct_{W}"].fillna(0.5)
-
-            # Calcular score con pesos consistentes para todos los buckets
-            gg[f"SCORE_SIMPLE_{W}"] = (
-                w_iv * gg[f"IV_pct_{W}"] +
-                w_sk * skew_pct_filled +
-                w_vrp * gg[f"VRP_pct_{W}"]
-            )
-            
-            gg[f"LEVEL10_SIMPLE_{W}"] = gg[f"SCORE_SIMPLE_{W}"].apply(level10_from_score)
-            gg[f"LABEL10_SIMPLE_{W}"] = gg[f"SCORE_SIMPLE_{W}"].apply(label10_from_score)
+        for col in ['SKEW_SMA63', 'SKEW_SD63', 'SKEW_Z63', 'SKEW_Z63_txt']:
+            if f'{col}_new' in gg.columns:
+                gg[col] = gg[f'{col}_new'].combine_first(gg.get(col, pd.Series()))
+                gg = gg.drop(columns=[f'{col}_new'])
+    
+    delta_rep_bucket = float(gg["delta_rep"].iloc[0])
+    is_atmish = (40.0 <= delta_rep_bucket <= 60.0)
+    
+    # ⚡ Límites de ventana compartidos por IV/SKEW/VRP y todas las W
+    plan = plan_calendar_windows(gg, full_trading_calendar, WINDOWS)
+    pct_values = np.vstack([
+        pd.to_numeric(gg[c], errors="coerce").to_numpy(dtype=float)
+        if c in gg.columns else np.full(len(gg), np.nan)
+        for c in ("IV_bucket", "SKEW_NORM_bucket", "VRP_7D_VOL")
+    ])
+    
+    for W in WINDOWS:
+        iv_pct, skew_pct, vrp_pct = calendar_percentiles_2d(pct_values, plan, W)
+        
+        gg[f"IV_pct_{W}"] = iv_pct
+        gg[f"coverage_{W}D"] = cov_gg[f"coverage_{W}D"].to_numpy()
+        gg[f"SKEW_pct_{W}"] = skew_pct
+        gg[f"VRP_pct_{W}"] = vrp_pct
         
-        out_frames.append(gg)
+        # 🔥 V20 FIX #2: Scores unificados con pesos consistentes
+        # Antes: ATM usaba pesos renormalizados (92.3% IV, 7.7% VRP, 0% SKEW)
+        #        OTM usaba pesos nominales (60% IV, 35% SKEW, 5% VRP)
+        # Problema: Scores ATM y OTM no comparables (diferentes escalas)
+        # Ahora: Pesos consistentes para todos los buckets
+        #        Para ATM: SKEW_pct se rellena con 0.5 (neutral) si es NaN
+
+        # Rellenar SKEW_pct con 0.5 (neutral) para buckets ATM donde puede ser NaN
+        skew_pct_filled = gg[f"SKEW_pct_{W}"].fillna(0.5)
+
+        # Calcular score con pesos consistentes para todos los buckets
+        gg[f"SCORE_SIMPLE_{W}"] = (
+            w_iv * gg[f"IV_pct_{W}"] +
+            w_sk * skew_pct_filled +
+            w_vrp * gg[f"VRP_pct_{W}"]
+        )
+        
+        gg[f"LEVEL10_SIMPLE_{W}"] = gg[f"SCORE_SIMPLE_{W}"].apply(level10_from_score)
+        gg[f"LABEL10_SIMPLE_{W}"] = gg[f"SCORE_SIMPLE_{W}"].apply(label10_from_score)
+    
+    return gg
+
+
+def _percentiles_for_buckets(
+    df_chunk: pd.DataFrame,
+    full_trading_calendar: TradingCalendar,
+    progress: bool = False
+) -> List[pd.DataFrame]:
+    """
+    Percentiles de un bloque de buckets completos (en orden de groupby)
+    
+    La cobertura es por bucket, así que se calcula vectorizada para el bloque.
+    """
+    df_chunk = df_chunk.reset_index(drop=True)
+    coverage = calculate_coverage_all_windows(df_chunk, WINDOWS, full_trading_calendar)
+    
+    iterator = df_chunk.groupby(PERCENTILE_GROUP_KEYS, sort=False)
+    if progress and _tqdm:
+        iterator = _tqdm(iterator, total=iterator.ngroups, desc="Percentiles")
+    
+    frames = []
+    for _, g in iterator:
+        gg = g.sort_values("date")
+        frames.append(_bucket_percentile_frame(gg, coverage.loc[gg.index], full_trading_calendar))
+    return frames
+
+
+# Calendario compartido por los workers del pool de percentiles (se envía una vez por worker)
+_WORKER_CALENDAR: Optional[TradingCalendar] = None
+
+
+def _init_percentile_worker(calendar: TradingCalendar):
+    """Inicializa el calendario compartido del worker"""
+    global _WORKER_CALENDAR
+    _WORKER_CALENDAR = calendar
+
+
+def _frame_to_payload(df: pd.DataFrame) -> Tuple[str, bytes]:
+    """Serializa un DataFrame como Arrow IPC (o pickle si Arrow no puede representarlo)"""
+    if pa is not None:
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return "arrow", sink.getvalue().to_pybytes()
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError):
+            pass
+    return "pickle", pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _frame_from_payload(payload: Tuple[str, bytes]) -> pd.DataFrame:
+    """Inversa de _frame_to_payload"""
+    kind, data = payload
+    if kind == "arrow":
+        return pa.ipc.open_stream(data).read_all().to_pandas()
+    return pickle.loads(data)
+
+
+def _percentile_chunk_worker(payload: Tuple[str, bytes]) -> Tuple[str, bytes]:
+    """Worker: percentiles de un bloque de buckets recibido como payload"""
+    df_chunk = _frame_from_payload(payload)
+    frames = _percentiles_for_buckets(df_chunk, _WORKER_CALENDAR)
+    return _frame_to_payload(pd.concat(frames, ignore_index=True))
+
+
+
+def split_percentile_state(
+    df: pd.DataFrame,
+    full_trading_calendar: TradingCalendar,
+    since: pd.Timestamp
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    ⚡ Modo incremental: (filas a calcular, filas intactas)
+    
+    Solo cambian las filas con fecha >= since (las ventanas miran hacia atrás).
+    Para calcularlas basta el estado de cada bucket: sus filas de los últimos
+    max(WINDOWS) días trading (percentiles y cobertura) y sus últimas
+    SKEW_Z_STATE_ROWS filas reales (SKEW z-score).
+    """
+    target = (df['date'] >= since).to_numpy()
+    
+    p_since, _ = full_trading_calendar.positions([since])
+    window_start = full_trading_calendar.days[max(int(p_since[0]) - max(WINDOWS), 0)]
     
+    real_before = df[~target & (df['IS_REAL_DATA'] == True).to_numpy()].sort_values('date')
+    from_end = real_before.groupby(PERCENTILE_GROUP_KEYS).cumcount(ascending=False)
+    skew_state = df.index.isin(from_end.index[from_end < SKEW_Z_STATE_ROWS])
+    
+    context = target | (df['date'] >= window_start).to_numpy() | skew_state
+    return df[context], df[~target]
+
+
+def calculate_bucket_percentiles(
+    df: pd.DataFrame,
+    full_trading_calendar: TradingCalendar,
+    since: Optional[pd.Timestamp] = None
+) -> pd.DataFrame:
+    """
+    V18: Cálculo de percentiles con calendario universal
+    
+    ⚡ Con varios workers los buckets se reparten en bloques sobre un
+    ProcessPoolExecutor (frames como Arrow IPC, calendario una vez por worker);
+    el resultado se concatena en el orden de los bloques (determinista).
+    
+    ⚡ Con `since` (modo incremental) solo se calculan las filas con fecha >= since
+    a partir del estado de cada bucket (split_percentile_state); el resto
+    conserva los valores de la superficie existente. Las filas de estado vienen
+    de la superficie guardada: sus celdas rellenas por el ffill se vacían
+    (sparse_fill_cells) para ver los mismos datos que en modo full.
+    """
+    logger.info("📊 Calculando percentiles sobre CALENDARIO UNIVERSAL USA...")
+    
+    df = df.reset_index(drop=True)
+    is_real = (df['IS_REAL_DATA'] == True) if 'IS_REAL_DATA' in df.columns else pd.Series(True, index=df.index)
+    df['_N_REAL_HISTORY'] = is_real.groupby([df[k] for k in PERCENTILE_GROUP_KEYS]).transform('sum')
+    
+    kept = None
+    if since is not None:
+        filled = sparse_fill_cells(df, full_trading_calendar)
+        df, kept = split_percentile_state(df, full_trading_calendar, since)
+        df = df.copy()
+        df[filled.columns] = df[filled.columns].mask(filled.loc[df.index])
+        logger.info(f"   Incremental desde {since.date()}: {len(df):,} filas de estado+nuevas, {len(kept):,} intactas")
+        df = df.reset_index(drop=True)
+    
+    df = df.drop(columns=[c for c in df.columns if PERCENTILE_OUTPUT_RE.fullmatch(c)])
+    bucket_rows = list(df.groupby(PERCENTILE_GROUP_KEYS, sort=False).indices.values())
+    total_buckets = len(bucket_rows)
+    logger.info(f"   Buckets a procesar: {total_buckets}")
+    
+    n_workers = PERCENTILE_WORKERS or MAX_WORKERS or os.cpu_count() or 1
+    n_workers = min(n_workers, max(1, total_buckets // PERCENTILE_BUCKETS_PER_TASK))
+    
+    if n_workers <= 1:
+        out_frames = _percentiles_for_buckets(df, full_trading_calendar, progress=True)
+    else:
+        logger.info(f"   Modo: PARALELO ({n_workers} workers)")
+        payloads = [
+            _frame_to_payload(df.iloc[np.concatenate(bucket_rows[i:i + PERCENTILE_BUCKETS_PER_TASK])])
+            for i in range(0, total_buckets, PERCENTILE_BUCKETS_PER_TASK)
+        ]
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_percentile_worker,
+            initargs=(full_trading_calendar,)
+        ) as executor:
+            results = executor.map(_percentile_chunk_worker, payloads)
+            if _tqdm:
+                results = _tqdm(results, total=len(payloads), desc="Percentiles")
+            out_frames = [_frame_from_payload(r) for r in results]
+    
+
     out = pd.concat(out_frames, ignore_index=True)
-    out = out.sort_values(["wing", "delta_rep", "dte_rep", "date"])
     
     rename_map = {}
     for c in list(out.columns):
@@ -1115,7 +1818,11 @@ def calculate_bucket_percentiles(
     if rename_map:
         out = out.rename(columns=rename_map)
     
-    drop_cols = [c for c in out.columns if c.startswith("LABEL_SIMPLE_")]
+    if kept is not None:
+        out = pd.concat([kept, out[out['date'] >= since]], ignore_index=True)
+    out = out.sort_values(["wing", "delta_rep", "dte_rep", "date"])
+    
+    drop_cols = [c for c in out.columns if c.startswith("LABEL_SIMPLE_")] + ['_N_REAL_HISTORY']
     out = out.drop(columns=drop_cols, errors="ignore")
     
     logger.info(f"   ✅ Percentiles calculados: {len(out):,} filas")
@@ -1147,7 +1854,7 @@ def calculate_hv_vrp(df: pd.DataFrame) -> pd.DataFrame:
     with np.errstate(divide='ignore', invalid='ignore'):
         spot_by_day["ret_log"] = np.log(spot_by_day["spot"] / spot_by_day["spot_prev"])
     
-    for W in [7, 21, 63, 252]:
+    for W in HV_WINDOWS:
         hv = spot_by_day["ret_log"].rolling(
             window=W,
             min_periods=max(3, W // 2)
@@ -1158,7 +1865,11 @@ def calculate_hv_vrp(df: pd.DataFrame) -> pd.DataFrame:
     
     hv_cols = ["date"] + [c for c in spot_by_day.columns if c.startswith("HV_")]
     
-    old_hv_cols = [c for c in df.columns if c.startswith("HV_") or c.startswith("VRP_")]
+    # VRP_pct_* son de la etapa de percentiles: se conservan (modo incremental)
+    old_hv_cols = [
+        c for c in df.columns
+        if (c.startswith("HV_") or c.startswith("VRP_")) and not PERCENTILE_OUTPUT_RE.fullmatch(c)
+    ]
     df = df.drop(columns=old_hv_cols, errors='ignore')
     
     df = df.merge(spot_by_day[hv_cols], on="date", how="left")
@@ -1219,7 +1930,7 @@ def calculate_iv_zscores(df: pd.DataFrame) -> pd.DataFrame:
         
         return df_series
     
-    for W in (20, 63, 252):
+    for W in IV_Z_WINDOWS:
         iv_day = add_zscores(iv_day, "IV_ATM_30D", W, "IV")
     
     iv_day["IV_STD1Up"] = iv_day["IV_SMA20"] + iv_day["IV_SD20"]
@@ -1243,76 +1954,319 @@ def calculate_iv_zscores(df: pd.DataFrame) -> pd.DataFrame:
 
 # ============================= RECÁLCULO INCREMENTAL =============================
 
-def recalculate_tail(df: pd.DataFrame, tail_days: int = RECALC_TAIL_DAYS) -> pd.DataFrame:
-    """Recálculo optimizado de cola"""
-    logger.info(f"🔄 Recalculando métricas para últimos {tail_days} días...")
-    
+# Columnas que recalculan calculate_hv_vrp y calculate_iv_zscores
+RECALC_COLUMNS_RE = re.compile(r"HV_\w+|VRP_7D_\w+|IV_ATM_bucket_filled|IV_ATM_30D|IV_(SMA|SD|Z|STD)\w*")
+
+
+def recalculate_tail(df: pd.DataFrame, since: pd.Timestamp) -> pd.DataFrame:
+    """
+    Recálculo acotado de HV/VRP y z-scores
+    
+    ⚡ since es la primera fecha cuyos inputs cambiaron (rango sucio). Solo se
+    recalculan las filas reales cuyas ventanas la alcanzan: `reach` fechas
+    reales desde since, con reach = ventana más larga (HV_WINDOWS,
+    IV_Z_WINDOWS, WINDOWS) o MAX_FFILL_DAYS, + 2 (retorno + T-1). El
+    contexto son las `reach` fechas reales anteriores más las últimas
+    MAX_FFILL_DAYS filas de cada bucket (IV_ATM_bucket_filled), con las celdas
+    rellenas por el ffill vacías como en modo full. El resto de filas no se
+    toca.
+    """
     if df.empty:
         return df
     
-    df = df.sort_values('date').copy()
-    max_date = df['date'].max()
-    cutoff_date = max_date - pd.Timedelta(days=tail_days)
+    reach = max(max(WINDOWS), max(HV_WINDOWS), max(IV_Z_WINDOWS), MAX_FFILL_DAYS) + 2
     
-    logger.info(f"   Fecha máxima: {max_date.date()} | Fecha corte: {cutoff_date.date()}")
+    df = df.loc[:, ~df.columns.duplicated()].reset_index(drop=True)
+    is_real = (df['IS_REAL_DATA'] == True).to_numpy() if 'IS_REAL_DATA' in df.columns else np.ones(len(df), dtype=bool)
+    dates = df['date']
     
-    df_base = df[df['date'] < cutoff_date].copy()
-    df_tail = df[df['date'] >= cutoff_date].copy()
+    real_dates = np.sort(dates[is_real].unique())
+    i0 = int(np.searchsorted(real_dates, np.datetime64(since, 'ns')))
+    if i0 >= len(real_dates):
+        return df
+    context_start = real_dates[max(i0 - reach, 0)]
+    dirty_end = real_dates[min(i0 + reach, len(real_dates) - 1)]
     
-    logger.info(f"   Base: {len(df_base):,} | Cola: {len(df_tail):,}")
+    logger.info(
+        f"🔄 Recalculando HV/VRP y z-scores: rango sucio {pd.Timestamp(since).date()} → "
+        f"{pd.Timestamp(dirty_end).date()} (contexto desde {pd.Timestamp(context_start).date()})"
+    )
     
-    if df_tail.empty:
-        return df
+    before = is_real & (dates < since).to_numpy()
+    from_end = df[before].sort_values('date', kind='stable').groupby(['wing', 'delta_code', 'dte_code']).cumcount(ascending=False)
+    ffill_state = df.index.isin(from_end.index[from_end < MAX_FFILL_DAYS])
     
-    lookback_days = tail_days + max(WINDOWS) + 30
-    lookback_date = max_date - pd.Timedelta(days=lookback_days)
-    df_for_calc = df[df['date'] >= lookback_date].copy()
+    in_calc = is_real & (dates <= dirty_end).to_numpy() & ((dates >= context_start).to_numpy() | ffill_state)
+    filled = sparse_fill_cells(df)
+    df_for_calc = df[in_calc].sort_values('date', kind='stable')
+    df_for_calc[filled.columns] = df_for_calc[filled.columns].mask(filled.loc[df_for_calc.index])
+    df_for_calc['_ROW'] = df_for_calc.index
     
-    logger.info(f"   Datos para cálculo: {len(df_for_calc):,} desde {lookback_date.date()}")
+    logger.info(f"   Datos para cálculo: {len(df_for_calc):,} de {len(df):,} filas")
     
     df_for_calc = calculate_hv_vrp(df_for_calc)
     df_for_calc = calculate_iv_zscores(df_for_calc)
     
-    df_tail_new = df_for_calc[df_for_calc['date'] >= cutoff_date].copy()
+    dirty = df_for_calc[df_for_calc['date'] >= since]
+    rows = dirty['_ROW'].to_numpy()
+    for col in [c for c in df_for_calc.columns if RECALC_COLUMNS_RE.fullmatch(c)]:
+        df.loc[rows, col] = dirty[col].to_numpy()
     
-    df_base = df_base.loc[:, ~df_base.columns.duplicated()]
-    df_tail_new = df_tail_new.loc[:, ~df_tail_new.columns.duplicated()]
+    df = df.sort_values(['wing', 'delta_rep', 'dte_rep', 'date']).reset_index(drop=True)
     
-    df_result = pd.concat([df_base, df_tail_new], ignore_index=True)
-    df_result = df_result.sort_values(['wing', 'delta_rep', 'dte_rep', 'date']).reset_index(drop=True)
+    logger.info(f"   ✅ Recálculo completado: {len(dirty):,} filas")
     
-    logger.info(f"   ✅ Recálculo completado: {len(df_result):,} filas")
+    return df
+
+
+# ============================= GESTIÓN DE ARCHIVOS =============================
+
+def detect_new_files(
+    input_dir: Path,
+    pattern: str,
+    existing_dates: Set[pd.Timestamp]
+) -> List[Path]:
+    """Detecta archivos nuevos no procesados"""
+    all_files = list(input_dir.glob(pattern))
+    new_files = []
+    
+    for f in all_files:
+        file_date = date_in_filename(f)
+        if file_date and file_date not in existing_dates:
+            new_files.append(f)
     
-    return df_result
+    new_files.sort(key=lambda p: date_in_filename(p) or pd.Timestamp.max)
+    return new_files
+
+
+def incremental_start_date(
+    existing_max: pd.Timestamp,
+    new_min: pd.Timestamp,
+    calendar: Optional[TradingCalendar] = None
+) -> pd.Timestamp:
+    """
+    Primera fecha a regenerar en modo incremental
+    
+    La primera fecha nueva o, si antes quedan días trading sin fichero tras
+    el final de la superficie existente, el primero de ellos (en modo full
+    esos días tienen filas forward-filled).
+    """
+    if new_min <= existing_max:
+        return new_min
+    if calendar is None:
+        calendar = get_trading_calendar(existing_max, new_min)
+    gap = calendar.range(existing_max + pd.Timedelta(days=1), new_min)
+    return gap[0] if len(gap) else new_min
+
+
+SURFACE_DATASET_DIRNAME = "surface_metrics"
+SURFACE_PARTITION_COLS = ["year", "month"]
+
+
+def _surface_partitioning():
+    return pa_ds.partitioning(
+        pa.schema([("year", pa.int32()), ("month", pa.int32())]), flavor="hive"
+    )
+
+
+def _surface_table(df: pd.DataFrame) -> "pa.Table":
+    """Tabla Arrow de la superficie con las columnas de partición year/month"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    dates = pd.to_datetime(df['date'])
+    table = table.append_column("year", pa.array(dates.dt.year.to_numpy(dtype=np.int32)))
+    return table.append_column("month", pa.array(dates.dt.month.to_numpy(dtype=np.int32)))
+
+
+def _surface_sidecars(dataset_dir: Path) -> Tuple[Path, Path]:
+    """Directorios hermanos del dataset: staging (.tmp) y copia de seguridad (.old)"""
+    return (
+        dataset_dir.with_name(dataset_dir.name + ".tmp"),
+        dataset_dir.with_name(dataset_dir.name + ".old"),
+    )
+
+
+def recover_surface_dataset(dataset_dir: Path):
+    """
+    Deshace un cambio de dataset interrumpido
+    
+    Lo que falte en el dataset (entero o por particiones year=/month=) se
+    restaura desde la copia .old; después se limpian .old y .tmp.
+    """
+    staging, backup = _surface_sidecars(dataset_dir)
+    if backup.exists():
+        if not dataset_dir.exists():
+            logger.warning(f"⚠️ Restaurando dataset desde {backup}")
+            os.replace(backup, dataset_dir)
+        else:
+            for month_dir in sorted(backup.glob("year=*/month=*")):
+                target = dataset_dir / month_dir.relative_to(backup)
+                if not target.exists():
+                    logger.warning(f"⚠️ Restaurando partición {target.relative_to(dataset_dir)}")
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(month_dir, target)
+        shutil.rmtree(backup, ignore_errors=True)
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def write_surface_dataset(df: pd.DataFrame, dataset_dir: Path, since: Optional[pd.Timestamp] = None) -> int:
+    """
+    ⚡ Escribe la superficie como dataset Parquet Hive (year=/month=)
+    
+    Con since solo se reescriben los meses con fechas >= since; el resto de
+    particiones no se toca. Sin since (o si el esquema cambió) se reescribe el
+    dataset entero. Se escribe primero en un directorio hermano (.tmp) y se
+    cambia con os.replace; lo sustituido se guarda en .old hasta terminar
+    (recover_surface_dataset lo restaura si el proceso muere a medias).
+    Devuelve el nº de filas escritas.
+    """
+    recover_surface_dataset(dataset_dir)
+    staging, backup = _surface_sidecars(dataset_dir)
+    
+    table = None
+    if since is not None and dataset_dir.exists():
+        month_start = pd.Timestamp(since).normalize().replace(day=1)
+        table = _surface_table(df[df['date'] >= month_start])
+        try:
+            schema = pa_ds.dataset(dataset_dir, format="parquet", partitioning=_surface_partitioning()).schema
+            if set(schema.names) != set(table.column_names):
+                raise ValueError("columnas distintas")
+            table = table.select(schema.names).cast(schema)
+        except (ValueError, pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            logger.warning(f"⚠️ Esquema distinto al del dataset existente ({e}): reescritura completa")
+            table = None
+    partial = table is not None
+    if not partial:
+        table = _surface_table(df)
+    
+    pa_ds.write_dataset(
+        table,
+        staging,
+        format="parquet",
+        partitioning=_surface_partitioning(),
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=pa_ds.ParquetFileFormat().make_write_options(compression="snappy"),
+    )
+    
+    if partial:
+        # Mes a mes: el anterior pasa a .old y el nuevo ocupa su sitio
+        for month_dir in sorted(staging.glob("year=*/month=*")):
+            rel = month_dir.relative_to(staging)
+            target = dataset_dir / rel
+            if target.exists():
+                (backup / rel).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(target, backup / rel)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(month_dir, target)
+    else:
+        if dataset_dir.exists():
+            os.replace(dataset_dir, backup)
+        os.replace(staging, dataset_dir)
+    
+    shutil.rmtree(backup, ignore_errors=True)
+    shutil.rmtree(staging, ignore_errors=True)
+    return table.num_rows
+
+
+def read_surface_dataset(dataset_dir: Path) -> pd.DataFrame:
+    """
+    Lee el dataset de superficie completo
+    
+    Devuelve el orden de la superficie en memoria: wing, delta_rep, dte_rep, date.
+    """
+    dataset = pa_ds.dataset(dataset_dir, format="parquet", partitioning=_surface_partitioning())
+    columns = [c for c in dataset.schema.names if c not in SURFACE_PARTITION_COLS]
+    df = dataset.to_table(columns=columns).to_pandas()
+    return df.sort_values(["wing", "delta_rep", "dte_rep", "date"]).reset_index(drop=True)
 
 
-# ============================= GESTIÓN DE ARCHIVOS =============================
+def _master_csv_tail_offset(master_csv: Path, header: bytes, since: pd.Timestamp) -> Optional[Tuple[int, int]]:
+    """
+    (offset, filas) de surface_metrics.csv antes de la primera fila con date >= since
 
-def detect_new_files(
-    input_dir: Path,
-    pattern: str,
-    existing_dates: Set[pd.Timestamp]
-) -> List[Path]:
-    """Detecta archivos nuevos no procesados"""
-    all_files = list(input_dir.glob(pattern))
-    new_files = []
-    
-    for f in all_files:
-        file_date = date_in_filename(f)
-        if file_date and file_date not in existing_dates:
-            new_files.append(f)
-    
-    new_files.sort(key=lambda p: date_in_filename(p) or pd.Timestamp.max)
-    return new_files
+    Busca en binario sobre las líneas del fichero (ordenado por fecha, la
+    fecha es la primera columna). None si la cabecera no coincide.
+    """
+    key = pd.Timestamp(since).strftime("%Y-%m-%d").encode()
+    with open(master_csv, "rb") as fh:
+        if fh.readline().rstrip(b"\r\n") != header:
+            return None
+        first, size = fh.tell(), master_csv.stat().st_size
+        
+        def line_start(pos: int) -> int:
+            if pos <= first:
+                return first
+            fh.seek(pos - 1)
+            fh.readline()
+            return fh.tell()
+        
+        def at_or_after_since(pos: int) -> bool:
+            fh.seek(line_start(pos))
+            line = fh.readline()
+            # EOF o última línea a medias (escritura interrumpida): se descarta
+            return not line.endswith(b"\n") or line[:len(key)] >= key
+        
+        lo, hi = first, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if at_or_after_since(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        offset = line_start(lo)
+        
+        fh.seek(first)
+        rows, remaining = 0, offset - first
+        while remaining > 0:
+            chunk = fh.read(min(remaining, 1 << 24))
+            rows += chunk.count(b"\n")
+            remaining -= len(chunk)
+    return offset, rows
+
+
+def write_master_csv(df: pd.DataFrame, master_csv: Path, since: Optional[pd.Timestamp] = None) -> int:
+    """
+    ⚡ Escribe surface_metrics.csv ordenado por fecha
+
+    Con since el fichero se trunca en la primera fila con date >= since y solo
+    se añaden esas fechas; si la cabecera o el nº de filas anteriores no
+    cuadran con df, se reescribe entero. Devuelve el nº de filas escritas.
+    """
+    header = ",".join(map(str, df.columns)).encode()
+    if since is not None and master_csv.exists():
+        found = _master_csv_tail_offset(master_csv, header, since)
+        if found is not None and found[1] == int((df['date'] < since).sum()):
+            tail = df[df['date'] >= since].sort_values('date', kind='stable')
+            with open(master_csv, "r+b") as fh:
+                fh.truncate(found[0])
+            tail.to_csv(master_csv, index=False, header=False, mode="a")
+            return len(tail)
+        logger.warning("⚠️ surface_metrics.csv no cuadra con la superficie: reescritura completa")
+    
+    tmp = master_csv.with_name(master_csv.name + ".tmp")
+    df.sort_values('date', kind='stable').to_csv(tmp, index=False)
+    os.replace(tmp, master_csv)
+    return len(df)
 
 
 def load_existing_surface(output_dir: Path) -> Optional[pd.DataFrame]:
-    """Carga superficie existente"""
+    """Carga superficie existente (dataset particionado, parquet legado o CSV)"""
+    dataset_dir = output_dir / SURFACE_DATASET_DIRNAME
     parquet_path = output_dir / "surface_metrics.parquet"
     csv_path = output_dir / "surface_metrics.csv"
     
     try:
-        if parquet_path.exists():
+        if pa_ds is not None:
+            recover_surface_dataset(dataset_dir)
+        if pa_ds is not None and dataset_dir.is_dir():
+            logger.info(f"📂 Cargando superficie existente: {dataset_dir}")
+            df = read_surface_dataset(dataset_dir)
+            logger.info(
+                f"   Filas: {len(df):,} | "
+                f"Rango: {df['date'].min().date()} → {df['date'].max().date()}"
+            )
+            return df
+        elif parquet_path.exists():
             logger.info(f"📂 Cargando superficie existente: {parquet_path}")
             df = pd.read_parquet(parquet_path)
             logger.info(
@@ -1337,52 +2291,298 @@ def load_existing_surface(output_dir: Path) -> Optional[pd.DataFrame]:
         return None
 
 
+# ============================= INGESTA DE CSV =============================
+
+def _csv_header(f: Path) -> List[str]:
+    """Lee solo la cabecera del CSV"""
+    with open(f, "r", encoding="utf-8-sig", newline="") as fh:
+        return next(csv.reader(fh), [])
+
+
+def _apply_on_uniques(s: pd.Series, fn) -> pd.Series:
+    """
+    Aplica fn una sola vez por valor único de s (como texto).
+    NaN se trata como 'nan', igual que astype(str).
+    """
+    codes, uniques = pd.factorize(s, sort=False)
+    txt = pd.Index(np.asarray(uniques, dtype=object)).astype(str).append(pd.Index(["nan"]))
+    codes = np.where(codes < 0, len(txt) - 1, codes)
+    mapped = np.asarray(fn(txt))
+    return pd.Series(mapped.take(codes), index=s.index)
+
+
+def _snapshot_mask(ms_norm: pd.Series) -> np.ndarray:
+    """Filas dentro de las ventanas 12:00 (TARGET_MS) y 15:30 (CLOSE_MS)"""
+    keep = (
+        ms_norm.between(TARGET_MS - TARGET_MS_TOLERANCE_MS, TARGET_MS + TARGET_MS_TOLERANCE_MS) |
+        ms_norm.between(CLOSE_MS - CLOSE_MS_TOLERANCE_MS, CLOSE_MS + CLOSE_MS_TOLERANCE_MS)
+    )
+    return keep.fillna(False).to_numpy(dtype=bool)
+
+
+def _arrow_ms_column(col) -> pd.Series:
+    """ms_of_day de un bloque arrow (pyarrow infiere 'HH:MM:SS' como time32/time64)"""
+    if pa.types.is_time(col.type):
+        mul, div = {"s": (1000, 1), "ms": (1, 1), "us": (1, 1000), "ns": (1, 1_000_000)}[col.type.unit]
+        raw = col.cast(pa.int32() if pa.types.is_time32(col.type) else pa.int64())
+        return raw.to_pandas().astype("Int64") * mul // div
+    return col.to_pandas()
+
+
+def _read_snapshot_rows_arrow(f: Path, usecols: List[str]) -> pd.DataFrame:
+    """Lectura por bloques con el motor CSV de pyarrow y tipos explícitos"""
+    column_types = {c: pa.float64() for c in CSV_FLOAT_COLUMNS if c in usecols}
+    column_types.update({
+        c: pa.dictionary(pa.int32(), pa.string()) for c in CSV_CATEGORY_COLUMNS if c in usecols
+    })
+    reader = pa_csv.open_csv(
+        f,
+        read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=usecols,
+            column_types=column_types,
+            strings_can_be_null=True,
+        ),
+    )
+    
+    batches, ms_parts = [], []
+    for batch in reader:
+        # La unidad de ms_of_day se detecta por bloque (mismo resultado que
+        # sobre el fichero completo salvo unidades mezcladas en un mismo CSV)
+        ms_norm = normalize_ms_of_day(_arrow_ms_column(batch.column("ms_of_day")))
+        keep = _snapshot_mask(ms_norm)
+        if keep.any():
+            batches.append(batch.filter(pa.array(keep)))
+            ms_parts.append(ms_norm[keep])
+    
+    df = pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+    df["ms_norm"] = (
+        pd.concat(ms_parts, ignore_index=True) if ms_parts else pd.Series(dtype="Int64")
+    )
+    return df
+
+
+def _read_snapshot_rows_pandas(f: Path, usecols: List[str]) -> pd.DataFrame:
+    """Fallback sin pyarrow: lectura por chunks con el motor C de pandas"""
+    parts = []
+    for chunk in pd.read_csv(f, usecols=usecols, low_memory=False, chunksize=CSV_CHUNK_ROWS):
+        ms_norm = normalize_ms_of_day(chunk["ms_of_day"])
+        keep = _snapshot_mask(ms_norm)
+        chunk = chunk.loc[keep].copy()
+        chunk["ms_norm"] = ms_norm[keep].to_numpy()
+        parts.append(chunk)
+    
+    if not parts:
+        return pd.DataFrame(columns=usecols + ["ms_norm"])
+    
+    df = pd.concat(parts, ignore_index=True)
+    df["ms_norm"] = df["ms_norm"].astype("Int64")
+    for c in CSV_FLOAT_COLUMNS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+    return df
+
+
+def read_snapshot_rows(f: Path) -> pd.DataFrame:
+    """
+    ⚡ Lectura proyectada, tipada y filtrada de un 30MINDATA_*.csv
+    
+    Solo lee REQUIRED_COLUMNS + OPTIONAL_COLUMNS con tipos explícitos
+    (motor pyarrow si está disponible) y filtra ms_of_day bloque a bloque:
+    solo se materializan las filas de los snapshots 12:00 y 15:30, con
+    'ms_norm' ya calculado. 'date', 'expiration' y 'right' se convierten
+    una sola vez por valor único.
+    """
+    header = _csv_header(f)
+    wanted = set(REQUIRED_COLUMNS) | set(OPTIONAL_COLUMNS)
+    usecols = list(dict.fromkeys(c for c in header if c in wanted))
+    
+    if "ms_of_day" not in usecols:
+        return pd.DataFrame(columns=usecols)
+    
+    df = None
+    if pa_csv is not None:
+        try:
+            df = _read_snapshot_rows_arrow(f, usecols)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            logger.debug(f"{f.name}: lectura tipada pyarrow falló ({e}), usando pandas")
+    
+    if df is None:
+        df = _read_snapshot_rows_pandas(f, usecols)
+    
+    if "right" in df.columns:
+        df["right"] = _apply_on_uniques(df["right"], lambda t: t.str.upper().str.strip())
+    if "date" in df.columns:
+        df["date"] = _apply_on_uniques(
+            df["date"], lambda t: pd.to_datetime(t.str.slice(0, 10), errors="coerce")
+        )
+    if "expiration" in df.columns:
+        df["expiration"] = _apply_on_uniques(
+            df["expiration"], lambda t: pd.to_datetime(t, errors="coerce")
+        )
+    
+    return df
+
+
+def _raw_cache_paths(f: Path) -> Tuple[Path, str]:
+    """
+    Ruta de caché para f (clave: ruta, tamaño, mtime y ventanas de snapshot)
+    y patrón glob de sus entradas (vigentes o no).
+    """
+    st = f.stat()
+    path_key = hashlib.sha1(str(f.resolve()).encode("utf-8")).hexdigest()[:8]
+    stat_key = hashlib.sha1(repr((
+        st.st_size, st.st_mtime_ns, RAW_CACHE_VERSION,
+        TARGET_MS, TARGET_MS_TOLERANCE_MS, CLOSE_MS, CLOSE_MS_TOLERANCE_MS,
+    )).encode("utf-8")).hexdigest()[:12]
+    prefix = f"{f.stem}-{path_key}"
+    return RAW_CACHE_DIR / f"{prefix}-{stat_key}.parquet", f"{prefix}-*.parquet"
+
+
+def load_snapshot_rows(f: Path) -> pd.DataFrame:
+    """
+    ⚡ read_snapshot_rows con caché columnar transparente
+    
+    Cada CSV se convierte una sola vez a Parquet (solo filas 12:00/15:30 y
+    columnas tipadas). Si el CSV cambia de tamaño o mtime, se regenera.
+    """
+    if not ENABLE_RAW_CACHE or pa is None:
+        return read_snapshot_rows(f)
+    
+    cache_path, pattern = _raw_cache_paths(f)
+    if cache_path.exists():
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception as e:
+            logger.debug(f"{cache_path.name}: caché ilegible ({e}), regenerando")
+    
+    df = read_snapshot_rows(f)
+    
+    try:
+        RAW_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        for stale in RAW_CACHE_DIR.glob(pattern):
+            stale.unlink(missing_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.debug(f"{f.name}: no se pudo escribir caché ({e})")
+    
+    return df
+
+
 # ============================= PROCESAMIENTO DE ARCHIVOS =============================
 
+def _bucket_config_hash() -> str:
+    """Hash de la configuración de la que depende _extract_file_buckets"""
+    cfg = (
+        RESULT_CACHE_VERSION, RAW_CACHE_VERSION,
+        TARGET_MS, TARGET_MS_TOLERANCE_MS, CLOSE_MS, CLOSE_MS_TOLERANCE_MS,
+        DELTA_BUCKETS, DTE_BUCKETS, SPX_PRICE_COL, USE_IV_BS,
+        ABS_SPREAD_MAX, PCT_SPREAD_MAX, MIN_PREMIUM, MAX_ASK_BID_RATIO,
+        REQUIRE_BID_POSITIVE, REQUIRE_ASK_POSITIVE, N_MIN_PER_BUCKET,
+        ENABLE_NEIGHBOR_EXPANSION, NEIGHBOR_DELTA_EXPAND, NEIGHBOR_DTE_EXPAND,
+        MIN_CONTRACTS_FOR_EXPANSION, ENABLE_INTERPOLATION, INTERPOLATION_METHOD,
+        ATM_INTERPOLATION, LN_RATIO_EPS,
+    )
+    return hashlib.sha1(repr(cfg).encode("utf-8")).hexdigest()[:12]
+
+
+def _file_content_hash(f: Path) -> str:
+    """
+    Hash del contenido de f. Se memoriza junto a (tamaño, mtime) en
+    RESULT_CACHE_DIR para no releer ficheros que no han cambiado.
+    """
+    st = f.stat()
+    path_key = hashlib.sha1(str(f.resolve()).encode("utf-8")).hexdigest()[:8]
+    memo_path = RESULT_CACHE_DIR / f"{f.stem}-{path_key}.hash"
+    stamp = f"{st.st_size} {st.st_mtime_ns}"
+    
+    try:
+        size, mtime, digest = memo_path.read_text(encoding="utf-8").split()
+        if f"{size} {mtime}" == stamp:
+            return digest
+    except (OSError, ValueError):
+        pass
+    
+    h = hashlib.blake2b(digest_size=20)
+    with open(f, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    
+    RESULT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    memo_path.write_text(f"{stamp} {digest}", encoding="utf-8")
+    return digest
+
+
 def _process_single_file(f: Path) -> Tuple[List[dict], Dict]:
+    """
+    ⚡ _extract_file_buckets memoizado por fichero
+    
+    Clave = hash de contenido + hash de configuración (_bucket_config_hash):
+    un cambio de parámetros invalida solo las entradas afectadas. Los
+    ficheros que fallan a mitad de proceso no se memoizan.
+    """
+    cache_path = None
+    if ENABLE_RESULT_CACHE:
+        try:
+            content_key = _file_content_hash(f)
+            cache_path = RESULT_CACHE_DIR / f"{content_key}-{_bucket_config_hash()}.pkl"
+            if cache_path.exists():
+                with open(cache_path, "rb") as fh:
+                    return pickle.load(fh)
+        except Exception as e:
+            logger.debug(f"{f.name}: caché de resultados no disponible ({e})")
+            cache_path = None
+    
+    rows_local, leader_local, complete = _extract_file_buckets(f)
+    
+    if cache_path is not None and complete:
+        try:
+            for stale in RESULT_CACHE_DIR.glob(f"{content_key}-*.pkl"):
+                stale.unlink(missing_ok=True)
+            tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as fh:
+                pickle.dump((rows_local, leader_local), fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            logger.debug(f"{f.name}: no se pudo escribir caché de resultados ({e})")
+    
+    return rows_local, leader_local
+
+
+def _extract_file_buckets(f: Path) -> Tuple[List[dict], Dict, bool]:
     """
     V18: Procesamiento mejorado con interpolación y expansión
+    
+    Devuelve (rows_local, leader_local, completo); completo=False si hubo error.
     """
     rows_local = []
     leader_local: Dict[Tuple[pd.Timestamp, str, str, str], Dict] = {}
     
     try:
-        df = pd.read_csv(f, low_memory=False)
+        # ⚡ Solo columnas usadas, ya tipadas y filtradas a los snapshots 12:00/15:30
+        df = load_snapshot_rows(f)
         
         if not validate_csv_schema(df, f.name):
-            return rows_local, leader_local
+            return rows_local, leader_local, True
         
         # Preparar columnas
         if USE_IV_BS and "IV_BS" in df.columns:
-            df["IV"] = pd.to_numeric(df["IV_BS"], errors="coerce")
+            df["IV"] = df["IV_BS"]
         elif "implied_vol" in df.columns:
-            df["IV"] = pd.to_numeric(df["implied_vol"], errors="coerce")
-        else:
-            df["IV"] = pd.to_numeric(df.get("IV", np.nan), errors="coerce")
+            df["IV"] = df["implied_vol"]
+        elif "IV" not in df.columns:
+            df["IV"] = np.nan
         
         if "delta" in df.columns:
-            df["delta_BS"] = pd.to_numeric(df["delta"], errors="coerce")
-        else:
-            df["delta_BS"] = pd.to_numeric(df.get("delta_BS", np.nan), errors="coerce")
-        
-        for c in ["strike", "bid", "ask", "mid", SPX_PRICE_COL, "r"]:
-            if c in df.columns:
-                df[c] = pd.to_numeric(df[c], errors="coerce")
-        
-        if "right" in df.columns:
-            df["right"] = df["right"].astype(str).str.upper().str.strip()
-        if "date" in df.columns:
-            df["date"] = pd.to_datetime(df["date"].astype(str).str.slice(0, 10), errors="coerce")
-        if "expiration" in df.columns:
-            df["expiration"] = pd.to_datetime(df["expiration"], errors="coerce")
-        
-        if "ms_of_day" in df.columns:
-            df["ms_norm"] = normalize_ms_of_day(df["ms_of_day"])
-        else:
-            df["ms_norm"] = pd.Series([np.nan] * len(df))
+            df["delta_BS"] = df["delta"]
+        elif "delta_BS" not in df.columns:
+            df["delta_BS"] = np.nan
         
         if df["ms_norm"].dropna().empty:
-            return rows_local, leader_local
+            return rows_local, leader_local, True
         
         # 🔥 V21 FIX #3: Filtrar snapshot 12:00 PM (mediodía)
         s12 = df.loc[
@@ -1393,7 +2593,7 @@ def _process_single_file(f: Path) -> Tuple[List[dict], Dict]:
         ].copy()
         
         if s12.empty:
-            return rows_local, leader_local
+            return rows_local, leader_local, True
 
         # Filtrar snapshot close
         s1530 = df.loc[
@@ -1433,7 +2633,7 @@ def _process_single_file(f: Path) -> Tuple[List[dict], Dict]:
 
         s12 = s12.loc[cond12].copy()
         if s12.empty:
-            return rows_local, leader_local
+            return rows_local, leader_local, True
         
         # Procesar close si existe
         if not s1530.empty:
@@ -1455,248 +2655,351 @@ def _process_single_file(f: Path) -> Tuple[List[dict], Dict]:
                 condc &= (s1530["ask"] > 0)
             s1530 = s1530.loc[condc].copy()
         
-        # Calcular ATM por expiración
-        atm_by_exp: Dict[pd.Timestamp, Tuple[float, float]] = {}
-        for exp, bloc in s12.groupby("expiration"):
-            if bloc.empty:
-                continue
-            idx_atm = (bloc["delta_abs"] - 0.50).abs().idxmin()
-            IV_ATM = float(bloc.loc[idx_atm, "IV"]) if idx_atm in bloc.index else np.nan
-            K_ATM = float(bloc.loc[idx_atm, "strike"]) if idx_atm in bloc.index else np.nan
-            atm_by_exp[exp] = (IV_ATM, K_ATM)
-
-        # IV_ATM_30D
+        # ⚡ Snapshot de cierre indexado una vez por contrato; mid_close unido a las filas 12:00
+        close_keys = ["right", "expiration", "strike"]
+        if not s1530.empty:
+            close_mid = s1530.groupby(close_keys)["mid"].median()
+            s12.loc[:, "mid_close"] = close_mid.reindex(
+                pd.MultiIndex.from_frame(s12[close_keys])
+            ).to_numpy(dtype=float)
+        else:
+            s12.loc[:, "mid_close"] = np.nan
+        s12.loc[:, "pnl_short_each"] = s12["mid"] - s12["mid_close"]
+        
         s12.loc[:, "day_norm"] = pd.to_datetime(s12["date"]).dt.normalize()
         day = s12["day_norm"].iloc[0]
         
-        term_candidates = []
-        for exp, (iv_atm, _k) in atm_by_exp.items():
-            if not np.isfinite(iv_atm):
-                continue
-            dte = int((pd.to_datetime(exp).normalize() - day).days)
-            if 20 <= dte <= 40:
-                term_candidates.append((dte, iv_atm))
+        # ⚡ ATM por expiración (argmin agrupado) e IV_ATM_30D
+        atm = locate_atm_by_expiration(s12, day)
+        IV_ATM_30D = term_atm_30d(atm)
+        
+        # ⚡ Pertenencia a buckets en una sola pasada (searchsorted + expansión vectorizada)
+        members = build_bucket_members(s12, day, atm)
+        if members.empty:
+            return rows_local, leader_local, True
+        
+        # ⚡ Métricas simples de todos los buckets en un único groupby
+        bucket_stats = members.groupby("gid", sort=True).agg(
+            expiration=("expiration", "first"),
+            right=("right", "first"),
+            delta_id=("delta_id", "first"),
+            dte_id=("dte_id", "first"),
+            dte=("dte", "first"),
+            N=("strike", "size"),
+            spread_med=("spread_pct", "median"),
+            delta_med_exp=("delta_pct", "median"),
+            n_expanded=("expansion_level", "sum"),
+            pnl_short_med=("pnl_short_each", "median"),
+        )
         
-        IV_ATM_30D = np.nan
-        if term_candidates:
-            IV_ATM_30D = sorted(term_candidates, key=lambda t: abs(t[0] - 30))[0][1]
+        # ⚡ Contratos líderes de todas las claves en una pasada
+        leader_local = select_bucket_leaders(
+            members, bucket_stats["spread_med"].to_numpy(), day
+        )
+        
+        # ⚡ SKEW robusto de todos los buckets en una pasada
+        skew_by_gid = calculate_robust_skew_grouped(members, atm)
         
-        # Procesar por expiración y wing
-        for exp, bloc in s12.groupby("expiration"):
-            dte = int((pd.to_datetime(exp).normalize() - day).days)
+        # ⚡ Interpolación a punto fijo de todos los buckets en una pasada
+        if ENABLE_INTERPOLATION:
+            interp_df = interpolate_to_fixed_points_batch(members, method=INTERPOLATION_METHOD)
+        
+        # Procesar por bucket (expiración × wing × delta)
+        for gid, sub in members.groupby("gid", sort=True):
+            st = bucket_stats.loc[gid]
+            exp = st["expiration"]
+            wing = st["right"]
+            db = DELTA_BUCKETS[int(st["delta_id"])]
+            dte_bucket = DTE_BUCKETS[int(st["dte_id"])]
+            dte = int(st["dte"])
+            iv_atm = atm.at[exp, "IV_ATM"]
             
-            # Buscar bucket DTE
-            dte_bucket = None
-            for tb in DTE_BUCKETS:
-                if (tb is DTE_BUCKETS[-1] and tb["low"] <= dte <= tb["high"]) or \
-                   (tb["low"] <= dte < tb["high"]):
-                    dte_bucket = tb
-                    break
+            # SKEW robusto (ya calculado por grupo)
+            SKEW_NORM_med = float(skew_by_gid[gid])
             
-            if dte_bucket is None:
-                continue
+            # Interpolar a punto fijo (ya calculado por lotes)
+            if ENABLE_INTERPOLATION:
+                IV_value = float(interp_df.at[gid, 'IV_interpolated'])
+                interp_quality = interp_df.at[gid, 'interpolation_quality']
+                n_used = int(interp_df.at[gid, 'n_contracts_used'])
+            else:
+                IV_value = safe_median(sub["IV"])
+                interp_quality = 'MEDIAN'
+                n_used = len(sub)
             
-            iv_atm, k_atm = atm_by_exp.get(exp, (np.nan, np.nan))
-            if not np.isfinite(iv_atm) or not np.isfinite(k_atm):
-                continue
+            # Otras métricas del bucket (ya agregadas)
+            spread_med = st["spread_med"]
+            N_contracts = int(st["N"])
+            delta_med_exp = st["delta_med_exp"]
+            dte_med_exp = float(dte)
+            # Moda de expansion_level (empate → 0)
+            expansion_level = int(st["n_expanded"] > N_contracts - st["n_expanded"])
             
-            # Preparar close data
-            if not s1530.empty:
-                s1530_exp = s1530.loc[
-                    s1530["expiration"] == exp,
-                    ["right", "expiration", "strike", "mid"]
-                ].copy()
-                s1530_exp = s1530_exp.rename(columns={"mid": "mid_close"})
-            else:
-                s1530_exp = pd.DataFrame(columns=["right", "expiration", "strike", "mid_close"])
+            # PnL intradiario (mediana por grupo de mid 12:00 - mid 15:30)
+            pnl_short_med = st["pnl_short_med"]
             
-            # Procesar por wing
-            for wing in ("P", "C"):
-                bloc_w = bloc.loc[bloc["right"] == wing].copy()
-                if bloc_w.empty:
-                    continue
-                
-                # Procesar por bucket delta
-                for db in DELTA_BUCKETS:
-                    # Expandir a vecinos si necesario
-                    if ENABLE_NEIGHBOR_EXPANSION:
-                        sub = expand_to_neighbors(bloc_w, db, dte_bucket, MIN_CONTRACTS_FOR_EXPANSION)
-                    else:
-                        low, high = db["low"] / 100.0, db["high"] / 100.0
-                        if db is DELTA_BUCKETS[-1]:
-                            sub = bloc_w.loc[
-                                (bloc_w["delta_abs"] >= low) & (bloc_w["delta_abs"] <= high)
-                            ].copy()
-                        else:
-                            sub = bloc_w.loc[
-                                (bloc_w["delta_abs"] >= low) & (bloc_w["delta_abs"] < high)
-                            ].copy()
-                        sub['expansion_level'] = 0
-                    
-                    if sub.empty:
-                        continue
-                    
-                    sub = sub.loc[sub["mid"] >= MIN_PREMIUM].copy()
-                    
-                    # Validar mínimo
-                    if sub.shape[0] < N_MIN_PER_BUCKET:
-                        continue
-                    
-                    # Calcular SKEW robusto
-                    if len(sub) >= 3:
-                        skew_series = calculate_robust_skew(
-                            sub, iv_atm, k_atm, wing, method='robust'
-                        )
-                        skew_vals = pd.to_numeric(skew_series, errors="coerce").dropna()
-                        SKEW_NORM_med = float(skew_vals.median()) if not skew_vals.empty else np.nan
-                    else:
-                        SKEW_NORM_med = np.nan
-                    
-                    # Interpolar a punto fijo
-                    if ENABLE_INTERPOLATION:
-                        interp_result = interpolate_to_fixed_point(
-                            sub, target_delta=db["rep"], target_dte=dte_bucket["rep"],
-                            method=INTERPOLATION_METHOD
-                        )
-                        IV_value = interp_result['IV_interpolated']
-                        interp_quality = interp_result['interpolation_quality']
-                        n_used = interp_result['n_contracts_used']
-                    else:
-                        IV_value = safe_median(sub["IV"])
-                        interp_quality = 'MEDIAN'
-                        n_used = len(sub)
-                    
-                    # Otras métricas del bucket
-                    spread_med = safe_median(sub["spread_pct"])
-                    N_contracts = int(sub.shape[0])
-                    delta_med_exp = safe_median(sub["delta_abs"] * 100.0)
-                    dte_med_exp = float(dte)
-                    
-                    # PnL intradiario
-                    pnl_short_med = np.nan
-                    if not s1530_exp.empty:
-                        pair = sub.merge(s1530_exp, on=["right", "expiration", "strike"], how="inner")
-                        if not pair.empty:
-                            pair = pair.loc[
-                                pd.to_numeric(pair["mid"], errors="coerce").notna() &
-                                pd.to_numeric(pair["mid_close"], errors="coerce").notna()
-                            ].copy()
-                            if not pair.empty:
-                                pair["pnl_short_each"] = pair["mid"] - pair["mid_close"]
-                                pnl_short_med = safe_median(pair["pnl_short_each"])
-                    
-                    # Selección de contrato líder
-                    key = (day, "PUT" if wing == "P" else "CALL", db["code"], dte_bucket["code"])
-                    
-                    width_d = max(db["high"] - db["low"], 1e-9)
-                    width_t = max(dte_bucket["high"] - dte_bucket["low"], 1e-9)
-                    
-                    cand = sub[["right", "expiration", "strike", "bid", "ask", "mid", 
-                               "delta_abs", "spread_pct"]].copy()
-                    cand["delta_pct"] = cand["delta_abs"] * 100.0
-                    cand["dte_days"] = dte
-                    cand["score_delta"] = (cand["delta_pct"] - db["rep"]).abs() / width_d
-                    cand["score_dte"] = abs(dte - dte_bucket["rep"]) / width_t
-                    
-                    denom_spread = float(spread_med) if (
-                        isinstance(spread_med, (int, float)) and spread_med > 1e-6
-                    ) else 0.02
-                    cand["score_spread"] = (cand["spread_pct"] / denom_spread)
-                    
-                    # Si hay volumen, priorizar liquidez
-                    if 'volume' in sub.columns:
-                        max_vol = sub['volume'].max()
-                        if max_vol > 0:
-                            cand = cand.merge(sub[['strike', 'volume']], on='strike', how='left')
-                            cand['score_volume'] = 1 - (cand['volume'] / max_vol)
-                            cand["score_pick"] = (
-                                0.4 * cand["score_delta"] + 
-                                0.2 * cand["score_dte"] + 
-                                0.2 * cand["score_spread"] +
-                                0.2 * cand["score_volume"]
-                            )
-                        else:
-                            cand["score_pick"] = (
-                                cand["score_delta"] + 0.5 * cand["score_dte"] + 0.5 * cand["score_spread"]
-                            )
-                    else:
-                        cand["score_pick"] = (
-                            cand["score_delta"] + 0.5 * cand["score_dte"] + 0.5 * cand["score_spread"]
-                        )
-                    
-                    idx_local = cand["score_pick"].idxmin()
-                    best = cand.loc[idx_local]
-                    
-                    # Buscar close del líder
-                    mid1530 = np.nan
-                    if not s1530_exp.empty:
-                        m = s1530_exp[
-                            (s1530_exp["right"] == best["right"]) &
-                            (s1530_exp["strike"] == best["strike"])
-                        ]
-                        if not m.empty:
-                            mid1530 = float(pd.to_numeric(m["mid_close"], errors="coerce").median())
-                    
-                    # Actualizar líder si es mejor
-                    prev = leader_local.get(key)
-                    improve = (
-                        prev is None or
-                        (float(best["score_pick"]) < prev["score_pick"]) or
-                        (abs(float(best["score_pick"]) - prev["score_pick"]) < 1e-12 and (
-                            (float(best["spread_pct"]) < prev["spread_pct"]) or
-                            (abs(float(best["delta_pct"]) - db["rep"]) <
-                             abs(prev["delta_pct"] - db["rep"]))
-                        ))
-                    )
-                    
-                    if improve:
-                        leader_local[key] = {
-                            "strike": float(best["strike"]),
-                            "dte": int(dte),
-                            "score_pick": float(best["score_pick"]),
-                            "spread_pct": float(best["spread_pct"]),
-                            "delta_pct": float(best["delta_pct"]),
-                            "bid10": float(best["bid"]) if pd.notna(best["bid"]) else np.nan,
-                            "ask10": float(best["ask"]) if pd.notna(best["ask"]) else np.nan,
-                            "mid10": float(best["mid"]) if pd.notna(best["mid"]) else np.nan,
-                            "mid1530": float(mid1530) if pd.notna(mid1530) else np.nan,
-                        }
-                    
-                    # Añadir fila con métricas
-                    rows_local.append({
-                        "date": day,
-                        "wing": "PUT" if wing == "P" else "CALL",
-                        "delta_code": db["code"],
-                        "delta_rep": db["rep"],
-                        "delta_low": db["low"],
-                        "delta_high": db["high"],
-                        "dte_code": dte_bucket["code"],
-                        "dte_rep": dte_bucket["rep"],
-                        "dte_low": dte_bucket["low"],
-                        "dte_high": dte_bucket["high"],
-                        "IV_bucket": IV_value,
-                        "IV_ATM_bucket": iv_atm,
-                        "SKEW_NORM_bucket": SKEW_NORM_med,
-                        "TERM_bucket": (
-                            iv_atm - (np.nan if np.isnan(IV_ATM_30D) else IV_ATM_30D)
-                        ),
-                        "spread_pct_med": spread_med,
-                        "N": N_contracts,
-                        "spot": spot12,
-                        "expiration": pd.to_datetime(exp).normalize(),
-                        "delta_med_exp": delta_med_exp,
-                        "dte_med_exp": dte_med_exp,
-                        "PNL_SHORT_bucket": pnl_short_med,
-                        "interpolation_quality": interp_quality,
-                        "n_contracts_used": n_used,
-                        "expansion_level": int(sub['expansion_level'].mode()[0]) if 'expansion_level' in sub.columns else 0
-                    })
+            # Añadir fila con métricas
+            rows_local.append({
+                "date": day,
+                "wing": "PUT" if wing == "P" else "CALL",
+                "delta_code": db["code"],
+                "delta_rep": db["rep"],
+                "delta_low": db["low"],
+                "delta_high": db["high"],
+                "dte_code": dte_bucket["code"],
+                "dte_rep": dte_bucket["rep"],
+                "dte_low": dte_bucket["low"],
+                "dte_high": dte_bucket["high"],
+                "IV_bucket": IV_value,
+                "IV_ATM_bucket": iv_atm,
+                "SKEW_NORM_bucket": SKEW_NORM_med,
+                "TERM_bucket": (
+                    iv_atm - (np.nan if np.isnan(IV_ATM_30D) else IV_ATM_30D)
+                ),
+                "spread_pct_med": spread_med,
+                "N": N_contracts,
+                "spot": spot12,
+                "expiration": pd.to_datetime(exp).normalize(),
+                "delta_med_exp": delta_med_exp,
+                "dte_med_exp": dte_med_exp,
+                "PNL_SHORT_bucket": pnl_short_med,
+                "interpolation_quality": interp_quality,
+                "n_contracts_used": n_used,
+                "expansion_level": expansion_level
+            })
         
-        return rows_local, leader_local
+        return rows_local, leader_local, True
     
     except Exception as e:
         logger.warning(f"Error procesando {f.name}: {e}")
-        return rows_local, leader_local
+        return rows_local, leader_local, False
+
+
+# ============================= AGREGACIÓN =============================
+
+BUCKET_KEYS = ["date", "wing", "delta_code", "dte_code"]
+
+
+def aggregate_bucket_rows(df_exp: pd.DataFrame) -> pd.DataFrame:
+    """
+    ⚡ Agregación día×wing×delta×DTE con groupby().agg nombrado (sin apply por grupo)
+
+    Mismas columnas y semántica que el antiguo agg_group: medianas y cuantiles
+    lineales ignorando NaN, N sumado, N_exps únicos, moda de
+    interpolation_quality (empate → el menor) y expansion_level truncado.
+    """
+    df_exp = df_exp.assign(N=pd.to_numeric(df_exp["N"], errors="coerce").fillna(0))
+    g = df_exp.groupby(BUCKET_KEYS, sort=True)
+
+    out = g.agg(
+        delta_rep=("delta_rep", "first"),
+        delta_low=("delta_low", "first"),
+        delta_high=("delta_high", "first"),
+        dte_rep=("dte_rep", "first"),
+        dte_low=("dte_low", "first"),
+        dte_high=("dte_high", "first"),
+        IV_bucket=("IV_bucket", "median"),
+        IV_ATM_bucket=("IV_ATM_bucket", "median"),
+        SKEW_NORM_bucket=("SKEW_NORM_bucket", "median"),
+        TERM_bucket=("TERM_bucket", "median"),
+        spread_pct_med=("spread_pct_med", "median"),
+        spot=("spot", "median"),
+        delta_med_in_bucket=("delta_med_exp", "median"),
+        dte_med_in_bucket=("dte_med_exp", "median"),
+        N=("N", "sum"),
+        N_exps=("expiration", "nunique"),
+        PNL_SHORT_bucket=("PNL_SHORT_bucket", "median"),
+        n_contracts_used=("n_contracts_used", "mean"),
+        expansion_level=("expansion_level", "mean"),
+    )
+
+    # Cuantiles en una pasada por columna
+    q_cols = {"delta_med_exp": "delta", "dte_med_exp": "dte",
+              "IV_bucket": "IV_bucket", "SKEW_NORM_bucket": "SKEW_NORM_bucket"}
+    for q in (0.25, 0.75):
+        qv = g[list(q_cols)].quantile(q)
+        for col, prefix in q_cols.items():
+            out[f"{prefix}_p{int(q * 100)}"] = qv[col]
+
+    # Moda de interpolation_quality: más frecuente, empate → menor valor
+    counts = (
+        df_exp.groupby(BUCKET_KEYS + ["interpolation_quality"], sort=True)
+        .size()
+        .rename("n_mode")
+        .reset_index()
+        .sort_values("n_mode", ascending=False, kind="stable")
+        .drop_duplicates(BUCKET_KEYS)
+        .set_index(BUCKET_KEYS)["interpolation_quality"]
+    )
+    out["interpolation_quality"] = counts.reindex(out.index).fillna("UNKNOWN")
+
+    out["N"] = out["N"].astype(int)
+    out["expansion_level"] = out["expansion_level"].astype(int)
+
+    columns = [
+        "date", "wing", "delta_code", "delta_rep", "delta_low", "delta_high",
+        "dte_code", "dte_rep", "dte_low", "dte_high",
+        "IV_bucket", "IV_ATM_bucket", "SKEW_NORM_bucket", "TERM_bucket",
+        "spread_pct_med", "spot", "delta_med_in_bucket", "dte_med_in_bucket",
+        "delta_p25", "delta_p75", "dte_p25", "dte_p75",
+        "IV_bucket_p25", "IV_bucket_p75", "SKEW_NORM_bucket_p25", "SKEW_NORM_bucket_p75",
+        "N", "N_exps", "PNL_SHORT_bucket", "interpolation_quality",
+        "n_contracts_used", "expansion_level",
+    ]
+    return (
+        out.reset_index()[columns]
+        .sort_values(["wing", "delta_rep", "dte_rep", "date"])
+        .reset_index(drop=True)
+    )
+
+
+LEADER_COLUMNS = {
+    "strike": "strike_leader",
+    "dte": "dte_leader",
+    "bid10": "leader_bid_10",
+    "ask10": "leader_ask_10",
+    "mid10": "leader_mid_10",
+    "mid1530": "leader_mid_1530",
+}
+
+
+def attach_leaders(
+    df_new: pd.DataFrame,
+    leader_by_bucket: Dict[Tuple[pd.Timestamp, str, str, str], Dict]
+) -> pd.DataFrame:
+    """
+    ⚡ Añade los contratos líder con un único merge por (date, wing, delta_code, dte_code)
+    """
+    if leader_by_bucket:
+        leaders = pd.DataFrame(
+            list(leader_by_bucket.values()),
+            index=pd.MultiIndex.from_tuples(list(leader_by_bucket.keys()), names=BUCKET_KEYS)
+        ).reindex(columns=list(LEADER_COLUMNS)).rename(columns=LEADER_COLUMNS).reset_index()
+    else:
+        leaders = pd.DataFrame(columns=BUCKET_KEYS + list(LEADER_COLUMNS.values()))
+        leaders = leaders.astype({c: float for c in LEADER_COLUMNS.values()})
+
+    keys = df_new[BUCKET_KEYS].assign(date=pd.to_datetime(df_new["date"]).dt.normalize())
+    matched = keys.merge(leaders, on=BUCKET_KEYS, how="left")
+
+    for col in LEADER_COLUMNS.values():
+        df_new[col] = matched[col].to_numpy()
+    df_new["PNL_SHORT_leader"] = df_new["leader_mid_10"] - df_new["leader_mid_1530"]
+    return df_new
+
+
+# ============================= EXPORTACIÓN POR BUCKET =============================
+
+BUCKET_CSV_KEYS = ["wing", "delta_rep", "dte_rep"]
+
+
+def _load_bucket_fingerprints(catalog_csv: Path) -> Dict[Tuple[str, int, int], Tuple[str, int, int]]:
+    """(fingerprint, filas, bytes) de cada bucket según el catálogo anterior"""
+    if not catalog_csv.exists():
+        return {}
+    try:
+        cat = pd.read_csv(catalog_csv)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo leer el catálogo anterior: {e}")
+        return {}
+    if "fingerprint" not in cat.columns or "bytes" not in cat.columns:
+        return {}
+    cat = cat.dropna(subset=["fingerprint", "bytes"])
+    return {
+        (r.wing, int(r.delta_rep), int(r.dte_rep)): (r.fingerprint, int(r.rows), int(r.bytes))
+        for r in cat.itertuples(index=False)
+    }
+
+
+def _fingerprint(header: bytes, row_hashes: np.ndarray) -> str:
+    return hashlib.sha1(header + row_hashes.tobytes()).hexdigest()
+
+
+def _write_bucket_csv(g: pd.DataFrame, fpath: Path, append_from: Optional[int], cat_row: dict) -> str:
+    """Escribe el CSV del bucket: completo, o solo las filas nuevas (append_from)"""
+    if append_from is None:
+        g.to_csv(fpath, index=False)
+        action = "rewritten"
+    else:
+        g.iloc[append_from:].to_csv(fpath, index=False, header=False, mode="a")
+        action = "appended"
+    cat_row["bytes"] = fpath.stat().st_size
+    return action
+
+
+def export_bucket_csvs(out: pd.DataFrame, out_dir: Path, catalog_csv: Path) -> List[dict]:
+    """
+    ⚡ CSVs por bucket: solo se escriben los buckets que cambiaron
+    
+    El catálogo guarda un fingerprint (cabecera + hash de cada fila, en orden
+    de fecha) por bucket. Si coincide, el CSV no se toca; si coincide el de
+    las filas anteriores, se añaden solo las nuevas; si no, se reescribe.
+    También guarda el tamaño del CSV: si el fichero no mide lo que dice el
+    catálogo (p. ej. un append interrumpido antes de guardar el catálogo) se
+    reescribe entero. Las escrituras van a un ThreadPoolExecutor. Devuelve
+    las filas del catálogo.
+    """
+    previous = _load_bucket_fingerprints(catalog_csv)
+    header = ",".join(map(str, out.columns)).encode()
+    row_hashes = pd.util.hash_pandas_object(out, index=False).to_numpy()
+    
+    cat_rows = []
+    jobs = []
+    counts = {"unchanged": 0}
+    for (wing, drep, trep), idx in out.groupby(BUCKET_CSV_KEYS, sort=False).indices.items():
+        idx = idx[np.argsort(out["date"].to_numpy()[idx], kind="stable")]
+        g = out.iloc[idx]
+        fname = f"{wing}_delta{int(drep)}_DTE{int(trep)}_metrics.csv"
+        fpath = out_dir / fname
+        fingerprint = _fingerprint(header, row_hashes[idx])
+        
+        prev_fp, prev_rows, prev_bytes = previous.get((wing, int(drep), int(trep)), (None, 0, -1))
+        size = fpath.stat().st_size if fpath.exists() else -1
+        if prev_fp is None or size != prev_bytes:
+            append_from = None
+        elif prev_fp != fingerprint:
+            prefix_ok = 0 < prev_rows < len(g) and _fingerprint(header, row_hashes[idx[:prev_rows]]) == prev_fp
+            append_from = prev_rows if prefix_ok else None
+        else:
+            append_from = -1
+        
+        real_pct = ((~g['IS_FORWARD_FILLED']).sum() / len(g) * 100) if len(g) else 0
+        
+        # Cobertura promedio
+        avg_coverage = {}
+        for W in WINDOWS:
+            cov_col = f'coverage_{W}D'
+            if cov_col in g.columns:
+                avg_coverage[f'avg_cov_{W}d'] = g[cov_col].mean() * 100
+        
+        cat_rows.append({
+            "wing": wing,
+            "delta_rep": int(drep),
+            "dte_rep": int(trep),
+            "filepath": str(fpath),
+            "rows": len(g),
+            "start_date": str(g["date"].min().date()) if len(g) else "",
+            "end_date": str(g["date"].max().date()) if len(g) else "",
+            "real_data_pct": real_pct,
+            "max_gap_days": g['DAYS_SINCE_REAL_DATA'].max() if len(g) else 0,
+            **avg_coverage,
+            "fingerprint": fingerprint,
+            "bytes": size,
+        })
+        if append_from == -1:
+            counts["unchanged"] += 1
+        else:
+            jobs.append((g, fpath, append_from, cat_rows[-1]))
+    
+    with ThreadPoolExecutor(max_workers=max(1, CSV_WRITE_WORKERS)) as executor:
+        for action in executor.map(lambda job: _write_bucket_csv(*job), jobs):
+            counts[action] = counts.get(action, 0) + 1
+    
+    logger.info(
+        f"   Reescritos: {counts.get('rewritten', 0)} | Ampliados: {counts.get('appended', 0)} | "
+        f"Sin cambios: {counts['unchanged']}"
+    )
+    return cat_rows
 
 
 # ============================= MAIN =============================
@@ -1834,49 +3137,8 @@ def main():
         logger.error("❌ DataFrame de expansión vacío.")
         return
     
-    def agg_group(g: pd.DataFrame) -> pd.Series:
-        return pd.Series({
-            "wing": g["wing"].iloc[0],
-            "delta_code": g["delta_code"].iloc[0],
-            "delta_rep": g["delta_rep"].iloc[0],
-            "delta_low": g["delta_low"].iloc[0],
-            "delta_high": g["delta_high"].iloc[0],
-            "dte_code": g["dte_code"].iloc[0],
-            "dte_rep": g["dte_rep"].iloc[0],
-            "dte_low": g["dte_low"].iloc[0],
-            "dte_high": g["dte_high"].iloc[0],
-            "IV_bucket": safe_median(g["IV_bucket"]),
-            "IV_ATM_bucket": safe_median(g["IV_ATM_bucket"]),
-            "SKEW_NORM_bucket": safe_median(g["SKEW_NORM_bucket"]),
-            "TERM_bucket": safe_median(g["TERM_bucket"]),
-            "spread_pct_med": safe_median(g["spread_pct_med"]),
-            "spot": safe_median(g["spot"]),
-            "delta_med_in_bucket": safe_median(g["delta_med_exp"]),
-            "dte_med_in_bucket": safe_median(g["dte_med_exp"]),
-            "delta_p25": safe_quantile(g["delta_med_exp"], 0.25),
-            "delta_p75": safe_quantile(g["delta_med_exp"], 0.75),
-            "dte_p25": safe_quantile(g["dte_med_exp"], 0.25),
-            "dte_p75": safe_quantile(g["dte_med_exp"], 0.75),
-            "IV_bucket_p25": safe_quantile(g["IV_bucket"], 0.25),
-            "IV_bucket_p75": safe_quantile(g["IV_bucket"], 0.75),
-            "SKEW_NORM_bucket_p25": safe_quantile(g["SKEW_NORM_bucket"], 0.25),
-            "SKEW_NORM_bucket_p75": safe_quantile(g["SKEW_NORM_bucket"], 0.75),
-            "N": int(pd.to_numeric(g["N"], errors="coerce").fillna(0).sum()),
-            "N_exps": int(g["expiration"].nunique()),
-            "PNL_SHORT_bucket": safe_median(g["PNL_SHORT_bucket"]),
-            "interpolation_quality": g["interpolation_quality"].mode()[0] if len(g["interpolation_quality"].mode()) > 0 else "UNKNOWN",
-            "n_contracts_used": safe_mean(g["n_contracts_used"]),
-            "expansion_level": int(safe_mean(g["expansion_level"]))
-        })
-    
-    df_new = (
-        df_exp
-        .groupby(["date", "wing", "delta_code", "dte_code"], as_index=False)
-        .apply(agg_group, include_groups=True)  # 🔧 Include groupby columns in group DataFrame
-        .reset_index(drop=True)
-        .sort_values(["wing", "delta_rep", "dte_rep", "date"])
-        .reset_index(drop=True)
-    )
+    # ⚡ Agregación vectorizada (groupby().agg nombrado)
+    df_new = aggregate_bucket_rows(df_exp)
     
     logger.info(f"✅ Agregación completada: {len(df_new):,} filas")
     
@@ -1884,63 +3146,22 @@ def main():
     logger.info("")
     logger.info("🎯 Añadiendo contratos líder...")
     
-    strike_leader = []
-    dte_leader = []
-    leader_bid_10 = []
-    leader_ask_10 = []
-    leader_mid_10 = []
-    leader_mid_1530 = []
-    pnl_short_leader = []
-    
-    for _, r in df_new.iterrows():
-        key = (
-            pd.to_datetime(r["date"]).normalize(),
-            r["wing"],
-            r["delta_code"],
-            r["dte_code"]
-        )
-        info = leader_by_bucket.get(key)
-        
-        if info is None:
-            strike_leader.append(np.nan)
-            dte_leader.append(np.nan)
-            leader_bid_10.append(np.nan)
-            leader_ask_10.append(np.nan)
-            leader_mid_10.append(np.nan)
-            leader_mid_1530.append(np.nan)
-            pnl_short_leader.append(np.nan)
-        else:
-            strike_leader.append(float(info["strike"]))
-            dte_leader.append(int(info["dte"]))
-            b10 = info.get("bid10", np.nan)
-            a10 = info.get("ask10", np.nan)
-            m10 = info.get("mid10", np.nan)
-            m1530 = info.get("mid1530", np.nan)
-            leader_bid_10.append(b10)
-            leader_ask_10.append(a10)
-            leader_mid_10.append(m10)
-            leader_mid_1530.append(m1530)
-            
-            try:
-                pnl_short_leader.append(float(m10) - float(m1530))
-            except Exception:
-                pnl_short_leader.append(np.nan)
-    
-    df_new["strike_leader"] = strike_leader
-    df_new["dte_leader"] = dte_leader
-    df_new["leader_bid_10"] = leader_bid_10
-    df_new["leader_ask_10"] = leader_ask_10
-    df_new["leader_mid_10"] = leader_mid_10
-    df_new["leader_mid_1530"] = leader_mid_1530
-    df_new["PNL_SHORT_leader"] = pnl_short_leader
+    df_new = attach_leaders(df_new, leader_by_bucket)
     
     logger.info(f"✅ Contratos líder añadidos")
     
     # COMBINAR CON SUPERFICIE EXISTENTE
+    incremental_since = None
     if existing_surface is not None and not existing_surface.empty:
         logger.info("")
         logger.info("🔗 Combinando con superficie existente...")
         
+        # Filas nuevas = datos reales (sin esto quedaban con IS_REAL_DATA NaN tras el concat)
+        df_new['IS_REAL_DATA'] = df_new['IV_bucket'].notna()
+        df_new['IS_FORWARD_FILLED'] = False
+        df_new[SPARSE_FILL_MASK_COL] = 0
+        incremental_since = incremental_start_date(existing_surface['date'].max(), df_new['date'].min())
+        
         df_combined = pd.concat([existing_surface, df_new], ignore_index=True)
         df_combined = df_combined.drop_duplicates(
             subset=['date', 'wing', 'delta_code', 'dte_code'],
@@ -1952,7 +3173,7 @@ def main():
         
         logger.info(f"   Total combinado: {len(df_combined):,} filas")
         
-        df_day = recalculate_tail(df_combined, tail_days=RECALC_TAIL_DAYS)
+        df_day = recalculate_tail(df_combined, since=incremental_since)
     else:
         logger.info("")
         logger.info("🆕 Primera generación completa...")
@@ -1972,10 +3193,11 @@ def main():
     
     start_date_with_buffer = start_date - pd.Timedelta(days=max(WINDOWS) + 50)
     
-    full_trading_calendar = get_trading_days(start_date_with_buffer, end_date)
+    # ⚡ Un único calendario para percentiles, cobertura y forward-fill
+    full_trading_calendar = TradingCalendar(start_date_with_buffer, end_date)
     
     logger.info(f"   Calendario generado:{len(full_trading_calendar)} días de trading")
-    logger.info(f"   Rango: {full_trading_calendar[0].date()} → {full_trading_calendar[-1].date()}")
+    logger.info(f"   Rango: {full_trading_calendar.days[0].date()} → {full_trading_calendar.days[-1].date()}")
     
     # CALCULAR PERCENTILES SOBRE DATOS REALES
     logger.info("")
@@ -2010,7 +3232,7 @@ def main():
         logger.info(f"   Datos reales: {n_real:,} / {n_total:,} ({n_real/n_total*100:.1f}%)")
 
     # Pasar calendario universal a la función de percentiles
-    df_day = calculate_bucket_percentiles(df_day, full_trading_calendar)
+    df_day = calculate_bucket_percentiles(df_day, full_trading_calendar, since=incremental_since)
     
     # FORWARD-FILL CONTROLADO
     logger.info("")
@@ -2020,19 +3242,14 @@ def main():
     
     logger.info(f"   Reindexando sobre días trading: {start_date.date()} → {end_date.date()}")
     
-    bucket_frames = []
-    
-    total_buckets = df_day.groupby(['wing', 'delta_code', 'dte_code']).ngroups
-    iterator = df_day.groupby(['wing', 'delta_code', 'dte_code'])
-    
-    if _tqdm:
-        iterator = _tqdm(iterator, total=total_buckets, desc="Forward-fill")
-    
-    for (wing, dcode, tcode), g in iterator:
-        g_filled = reindex_and_ffill_controlled(g, start_date, end_date, MAX_FFILL_DAYS)
-        bucket_frames.append(g_filled)
-    
-    df_day = pd.concat(bucket_frames, ignore_index=True)
+    if incremental_since is not None:
+        df_day = extend_ffill_incremental(
+            df_day, incremental_since, end_date, MAX_FFILL_DAYS, calendar=full_trading_calendar
+        )
+    else:
+        df_day = reindex_and_ffill_controlled(
+            df_day, start_date, end_date, MAX_FFILL_DAYS, calendar=full_trading_calendar
+        )
     df_day = df_day.sort_values(
         ['wing', 'delta_rep', 'dte_rep', 'date']
     ).reset_index(drop=True)
@@ -2151,56 +3368,34 @@ def main():
     logger.info("💾 GUARDANDO ARCHIVOS")
     logger.info("=" * 70)
     
-    master_parquet = out_dir / "surface_metrics.parquet"
+    master_dataset = out_dir / SURFACE_DATASET_DIRNAME
     master_csv = out_dir / "surface_metrics.csv"
     catalog_csv = out_dir / "surface_catalog.csv"
     
-    # Parquet
-    if WRITE_PARQUET:
+    # CSV principal (antes que el dataset: si el proceso muere entre ambos, la
+    # siguiente ejecución vuelve a procesar los mismos ficheros y lo repara)
+    if WRITE_MASTER_CSV:
+        n_written = write_master_csv(out, master_csv, since=incremental_since)
+        logger.info(f"✅ CSV principal: {master_csv}")
+        logger.info(f"   Filas: {len(out):,} | Escritas: {n_written:,}")
+    
+    # Parquet: dataset particionado, en incremental solo los meses tocados
+    if WRITE_PARQUET and pa_ds is not None:
         try:
-            out.to_parquet(master_parquet, index=False, compression='snappy')
-            size_mb = master_parquet.stat().st_size / 1024 ** 2
-            logger.info(f"✅ Parquet: {master_parquet}")
-            logger.info(f"   Tamaño: {size_mb:.1f} MB")
+            n_written = write_surface_dataset(out, master_dataset, since=incremental_since)
+            size_mb = sum(p.stat().st_size for p in master_dataset.rglob("*.parquet")) / 1024 ** 2
+            logger.info(f"✅ Parquet (dataset year/month): {master_dataset}")
+            logger.info(f"   Filas escritas: {n_written:,} | Tamaño total: {size_mb:.1f} MB")
         except Exception as e:
             logger.warning(f"⚠️ No se pudo escribir parquet: {e}")
-    
-    # CSV principal
-    out.to_csv(master_csv, index=False)
-    logger.info(f"✅ CSV principal: {master_csv}")
-    logger.info(f"   Filas: {len(out):,}")
+    elif WRITE_PARQUET:
+        logger.warning("⚠️ pyarrow no disponible: no se escribe el dataset parquet")
     
     # CSVs segregados por bucket
     logger.info("")
     logger.info("📁 Generando CSVs por bucket...")
     
-    cat_rows = []
-    for (wing, drep, trep), g in out.groupby(["wing", "delta_rep", "dte_rep"], sort=False):
-        fname = f"{wing}_delta{int(drep)}_DTE{int(trep)}_metrics.csv"
-        fpath = out_dir / fname
-        g.sort_values("date").to_csv(fpath, index=False)
-        
-        real_pct = ((~g['IS_FORWARD_FILLED']).sum() / len(g) * 100) if len(g) else 0
-        
-        # Cobertura promedio
-        avg_coverage = {}
-        for W in WINDOWS:
-            cov_col = f'coverage_{W}D'
-            if cov_col in g.columns:
-                avg_coverage[f'avg_cov_{W}d'] = g[cov_col].mean() * 100
-        
-        cat_rows.append({
-            "wing": wing,
-            "delta_rep": int(drep),
-            "dte_rep": int(trep),
-            "filepath": str(fpath),
-            "rows": len(g),
-            "start_date": str(g["date"].min().date()) if len(g) else "",
-            "end_date": str(g["date"].max().date()) if len(g) else "",
-            "real_data_pct": real_pct,
-            "max_gap_days": g['DAYS_SINCE_REAL_DATA'].max() if len(g) else 0,
-            **avg_coverage
-        })
+    cat_rows = export_bucket_csvs(out, out_dir, catalog_csv)
     
     pd.DataFrame(cat_rows).to_csv(catalog_csv, index=False)
     logger.info(f"✅ Catálogo: {catalog_csv}")
@@ -2822,13 +4017,9 @@ def _execute_main_with_analysis():
     out_dir = Path(OUTPUT_DIR)
 
     # Cargar superficie generada
-    if (out_dir / "surface_metrics.parquet").exists():
-        df = pd.read_parquet(out_dir / "surface_metrics.parquet")
-    elif (out_dir / "surface_metrics.csv").exists():
-        df = pd.read_csv(out_dir / "surface_metrics.csv", parse_dates=['date'])
-    else:
+    df = load_existing_surface(out_dir)
+    if df is None:
         logger.warning("⚠️ No se pudo cargar superficie para análisis adicional")
-        df = None
 
     if df is not None:
         logger.info("")
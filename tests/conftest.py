@@ -0,0 +1,16 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+SCRIPT = Path(__file__).resolve().parents[1] / "V22 [PERMA SURFACE]. Auto-loop execution. Incremental mode + forward fill.py"
+
+
+@pytest.fixture(scope="session")
+def surface():
+    spec = importlib.util.spec_from_file_location("surface_v22", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["surface_v22"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,163 @@
+"""
+Regresión: el forward-fill incremental (extend_ffill_incremental) debe dar
+las mismas filas >= since que un forward-fill completo sobre todo el histórico.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+LIMIT = 30
+COMPARE = [
+    'wing', 'delta_code', 'dte_code', 'delta_rep', 'dte_rep',
+    'IV_bucket', 'SKEW_NORM_bucket', 'PNL_SHORT_bucket', 'N',
+    'DAYS_SINCE_REAL_DATA', 'DATA_QUALITY', 'IS_FORWARD_FILLED', 'FFILL_SPARSE_MASK',
+]
+
+
+def _bucket_rows(days, wing, delta, dte, values):
+    n = len(days)
+    return pd.DataFrame({
+        'date': days,
+        'wing': wing,
+        'delta_code': f"d{delta}",
+        'dte_code': f"t{dte}",
+        'delta_rep': float(delta),
+        'dte_rep': float(dte),
+        'IV_bucket': values['IV_bucket'],
+        'SKEW_NORM_bucket': values['SKEW_NORM_bucket'],
+        'PNL_SHORT_bucket': values['PNL_SHORT_bucket'],
+        'N': np.full(n, 5),
+        'IS_REAL_DATA': True,
+        'IS_FORWARD_FILLED': False,
+    })
+
+
+def _full_vs_incremental(surface, raw, since, legacy=False):
+    calendar = surface.TradingCalendar(raw['date'].min() - pd.Timedelta(days=10), raw['date'].max())
+    end = raw['date'].max()
+
+    full = surface.reindex_and_ffill_controlled(raw, raw['date'].min(), end, LIMIT, calendar=calendar)
+    full = surface.remove_empty_rows(full)
+
+    stored = full[full['date'] < since]
+    if legacy:
+        # Superficie de una versión sin máscara de relleno
+        stored = stored.drop(columns='FFILL_SPARSE_MASK')
+    # Como en main: las filas nuevas no tienen celdas rellenas
+    new = raw[raw['date'] >= since].assign(FFILL_SPARSE_MASK=0)
+    combined = pd.concat([stored, new], ignore_index=True)
+    inc = surface.extend_ffill_incremental(combined, since, end, LIMIT, calendar=calendar)
+    inc = surface.remove_empty_rows(inc)
+
+    # Las filas históricas no se tocan
+    hist_cols = [c for c in COMPARE if c in stored.columns]
+    hist = inc[inc['date'] < since].sort_values(['wing', 'delta_code', 'dte_code', 'date'])
+    pd.testing.assert_frame_equal(
+        hist[hist_cols].reset_index(drop=True),
+        stored.sort_values(['wing', 'delta_code', 'dte_code', 'date'])[hist_cols].reset_index(drop=True),
+    )
+
+    key = ['wing', 'delta_code', 'dte_code', 'date']
+    expected = full[full['date'] >= since].sort_values(key)[COMPARE].reset_index(drop=True)
+    got = inc[inc['date'] >= since].sort_values(key)[COMPARE].reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False)
+
+
+def test_exhausted_sparse_fill_is_not_reseeded(surface):
+    # PNL_SHORT solo es original el día 10; las filas reales 11..25 llegan sin
+    # él y su relleno se agota el día 40. Las filas fantasma tras since no
+    # deben volver a rellenarse desde la última fila real (día 25).
+    days = surface.TradingCalendar(pd.Timestamp("2024-01-02"), pd.Timestamp("2024-06-28")).days[:70]
+    real = np.r_[0:26, 50:70]
+    rng = np.random.default_rng(1)
+    pnl = rng.normal(size=len(real))
+    pnl[(real > 10) & (real < 50)] = np.nan
+    raw = _bucket_rows(days[real], "CALL", 50, 150, {
+        'IV_bucket': rng.uniform(0.1, 0.3, len(real)),
+        'SKEW_NORM_bucket': rng.normal(size=len(real)),
+        'PNL_SHORT_bucket': pnl,
+    })
+
+    _full_vs_incremental(surface, raw, since=days[45])
+
+
+def _random_raw(rng, days, pnl_values=None):
+    frames = []
+    for wing, delta, dte in [("PUT", 25, 30), ("CALL", 10, 90), ("CALL", 50, 150)]:
+        present = rng.random(len(days)) > 0.25
+        for start in rng.integers(10, 150, size=3):
+            present[start:start + rng.integers(5, 40)] = False  # huecos largos
+        idx = np.flatnonzero(present)
+        pnl = rng.normal(size=len(idx)) if pnl_values is None else rng.choice(pnl_values, len(idx))
+        values = {
+            'IV_bucket': rng.uniform(0.1, 0.3, len(idx)),
+            'SKEW_NORM_bucket': np.where(rng.random(len(idx)) < 0.3, np.nan, rng.normal(size=len(idx))),
+            'PNL_SHORT_bucket': np.where(rng.random(len(idx)) < 0.85, np.nan, pnl),
+        }
+        frames.append(_bucket_rows(days[idx], wing, delta, dte, values))
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+@pytest.mark.parametrize("seed", range(8))
+def test_incremental_matches_full_run(surface, seed, legacy):
+    rng = np.random.default_rng(seed)
+    days = surface.TradingCalendar(pd.Timestamp("2023-01-03"), pd.Timestamp("2023-12-29")).days[:160]
+    raw = _random_raw(rng, days)
+
+    for since in days[20:160:10]:
+        _full_vs_incremental(surface, raw, since=since, legacy=legacy)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_repeated_discrete_values_are_not_fills(surface, seed):
+    # PNL_SHORT discreto: un valor original igual al del día anterior sigue
+    # siendo dato original (la máscara guardada lo distingue del relleno)
+    rng = np.random.default_rng(seed)
+    days = surface.TradingCalendar(pd.Timestamp("2023-01-03"), pd.Timestamp("2023-12-29")).days[:160]
+    raw = _random_raw(rng, days, pnl_values=[-1.0, 0.0, 1.0])
+
+    for since in days[20:160:10]:
+        _full_vs_incremental(surface, raw, since=since)
+
+
+def test_stored_surface_ending_before_new_files(surface):
+    # Faltan los ficheros de days[80:83]: la superficie guardada acaba en
+    # days[79] y los nuevos empiezan en days[83]. En modo full esos días
+    # tienen filas forward-filled, así que el incremental arranca en days[80].
+    rng = np.random.default_rng(11)
+    days = surface.TradingCalendar(pd.Timestamp("2023-01-03"), pd.Timestamp("2023-12-29")).days[:160]
+    raw = _random_raw(rng, days)
+    raw = raw[~raw['date'].isin(days[80:83])]
+
+    stored_max = raw.loc[raw['date'] < days[80], 'date'].max()
+    since = surface.incremental_start_date(stored_max, days[83])
+    assert since == days[80]
+    _full_vs_incremental(surface, raw, since=since)
+
+
+def test_backfilled_day_matches_full_run(surface):
+    # Se procesa tarde el fichero de days[60]: la superficie guardada ya tiene
+    # filas reales posteriores, cuyas celdas rellenas no deben contar como dato
+    rng = np.random.default_rng(5)
+    days = surface.TradingCalendar(pd.Timestamp("2023-01-03"), pd.Timestamp("2023-12-29")).days[:160]
+    raw = _random_raw(rng, days)
+    calendar = surface.TradingCalendar(days[0] - pd.Timedelta(days=10), days[-1])
+    since, end = days[60], raw['date'].max()
+
+    def ffill(rows):
+        out = surface.reindex_and_ffill_controlled(rows, rows['date'].min(), end, LIMIT, calendar=calendar)
+        return surface.remove_empty_rows(out)
+
+    full = ffill(raw)
+    stored = ffill(raw[raw['date'] != since])
+    combined = pd.concat([stored, raw[raw['date'] == since].assign(FFILL_SPARSE_MASK=0)], ignore_index=True)
+    combined = combined.drop_duplicates(subset=['date', 'wing', 'delta_code', 'dte_code'], keep='last')
+    inc = surface.remove_empty_rows(surface.extend_ffill_incremental(combined, since, end, LIMIT, calendar=calendar))
+
+    key = ['wing', 'delta_code', 'dte_code', 'date']
+    expected = full[full['date'] >= since].sort_values(key)[COMPARE].reset_index(drop=True)
+    got = inc[inc['date'] >= since].sort_values(key)[COMPARE].reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False)
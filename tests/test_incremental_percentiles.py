@@ -0,0 +1,68 @@
+"""
+Regresión: en modo incremental, percentiles y SKEW z-score de las filas
+>= since deben coincidir con un cálculo completo. Las filas de estado vienen
+de la superficie guardada (ya forward-filled) y su relleno no cuenta.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+LIMIT = 30
+KEY = ['wing', 'delta_code', 'dte_code', 'date']
+
+
+def _raw(rng, days):
+    frames = []
+    for wing, delta, dte in [("PUT", 25, 30), ("CALL", 50, 90), ("CALL", 10, 150)]:
+        present = rng.random(len(days)) > 0.2
+        for start in rng.integers(10, len(days) - 40, size=3):
+            present[start:start + rng.integers(5, 30)] = False  # huecos largos
+        idx = np.flatnonzero(present)
+        n = len(idx)
+        frames.append(pd.DataFrame({
+            'date': days[idx],
+            'wing': wing,
+            'delta_code': f"d{delta}",
+            'dte_code': f"t{dte}",
+            'delta_rep': float(delta),
+            'dte_rep': float(dte),
+            'IV_bucket': rng.uniform(0.1, 0.3, n),
+            'SKEW_NORM_bucket': np.where(rng.random(n) < 0.3, np.nan, rng.normal(size=n)),
+            'VRP_7D_VOL': np.where(rng.random(n) < 0.2, np.nan, rng.normal(scale=0.02, size=n)),
+            'N': np.full(n, 5),
+            'IS_REAL_DATA': True,
+            'IS_FORWARD_FILLED': False,
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+@pytest.mark.parametrize("seed", range(3))
+def test_incremental_percentiles_match_full_run(surface, seed, legacy):
+    rng = np.random.default_rng(seed)
+    days = surface.TradingCalendar(pd.Timestamp("2022-01-03"), pd.Timestamp("2022-12-30")).days[:220]
+    raw = _raw(rng, days)
+    end = raw['date'].max()
+    calendar = surface.TradingCalendar(days[0] - pd.Timedelta(days=120), end)
+
+    full_pct = surface.calculate_bucket_percentiles(raw.copy(), calendar)
+    full = surface.reindex_and_ffill_controlled(full_pct, full_pct['date'].min(), end, LIMIT, calendar=calendar)
+    full = surface.remove_empty_rows(full)
+    if legacy:
+        # Superficie de una versión sin máscara de relleno
+        full = full.drop(columns='FFILL_SPARSE_MASK')
+
+    columns = [c for c in full_pct.columns if surface.PERCENTILE_OUTPUT_RE.fullmatch(c) or c.startswith('SKEW_')]
+    columns = [c for c in columns if not c.endswith('_txt')]
+    assert {'SKEW_pct_21', 'VRP_pct_63', 'SKEW_Z63', 'SCORE_SIMPLE_21'} <= set(columns)
+
+    for since in days[100:220:20]:
+        stored = full[full['date'] < since]
+        new = raw[raw['date'] >= since].assign(FFILL_SPARSE_MASK=0)
+        combined = pd.concat([stored, new], ignore_index=True)
+        inc = surface.calculate_bucket_percentiles(combined, calendar, since=since)
+
+        expected = full_pct[full_pct['date'] >= since].sort_values(KEY)[columns].reset_index(drop=True)
+        got = inc[inc['date'] >= since].sort_values(KEY)[columns].reset_index(drop=True)
+        pd.testing.assert_frame_equal(got, expected, check_dtype=False)